@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import json
+import os
+import signal
+import sys
+import time
+import lab
+
+# resource is only available on unix, and only needed for memory limits
+try:
+    import resource
+except ImportError:
+    resource = None
+
+'''
+~~~~~~~~~~~~~~~~~~~~~~~~~ JOBS ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# a job is a .crl file, run with evaluate_file, or a .json file holding a
+# list of expressions in the test_inputs format, run one after another as
+# test.py does
+# every job runs in a fresh global Environment on a worker process, and
+# its result is a dict that can be written as a line of JSON:
+#   job:     path of the job's file
+#   ok:      whether it ran without an uncaught error
+#   value:   value of a .crl file's last expression
+#   results: {'ok', 'output'} or {'ok', 'type'} for each expression of a
+#            .json file
+#   error:   name of the error that stopped the job, or 'Timeout'
+#   time:    seconds the job ran for
+
+# raised in a worker when its job runs out of time
+# not an Exception, so evaluation carrying on after errors cannot catch it
+class JobTimeout(BaseException):
+    pass
+
+# carlae value as JSON: lists become arrays, the empty list [] and values
+# such as functions their type's name
+def json_value(value):
+    if value is None:
+        return []
+    if isinstance(value, lab.LinkedList):
+        return [json_value(elt) for elt in value]
+    if isinstance(value, (bool, int, float)):
+        return value
+    return '<%s>' % type(value).__name__
+
+def run_file(path):
+    return {'value': json_value(lab.evaluate_file(path))}
+
+# runs the expressions of a .json job, carrying on after errors
+def run_sequence(path):
+    with open(path) as f:
+        expressions = json.load(f)
+    env = lab.Environment()
+    results = []
+    for expression in expressions:
+        try:
+            results.append({'ok': True, 'output': json_value(lab.evaluate(expression, env))})
+        except Exception as e:
+            results.append({'ok': False, 'type': type(e).__name__})
+    return {'results': results}
+
+def raise_timeout(signum, frame):
+    raise JobTimeout
+
+# runs a job on a worker, stopping it after timeout seconds and letting it
+# use at most memory_limit bytes of address space, if they are given
+def run_job(path, timeout = None, memory_limit = None):
+    start = time.perf_counter()
+    result = {'job': path}
+    if timeout is not None:
+        signal.signal(signal.SIGALRM, raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    if memory_limit is not None and resource is not None:
+        old_limit = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, old_limit[1]))
+    try:
+        if path.endswith('.json'):
+            result.update(run_sequence(path))
+        else:
+            result.update(run_file(path))
+        result['ok'] = True
+    except JobTimeout:
+        result.update(ok = False, error = 'Timeout')
+    except Exception as e:
+        result.update(ok = False, error = type(e).__name__)
+    finally:
+        if timeout is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if memory_limit is not None and resource is not None:
+            resource.setrlimit(resource.RLIMIT_AS, old_limit)
+    result['time'] = time.perf_counter() - start
+    return result
+
+# runs every job on a pool of workers processes, yielding their results in
+# the order they finish
+# jobs that kill their worker are reported with the error that caused, and
+# the pool is not reused after that
+def run_batch(paths, workers = None, timeout = None, memory_limit = None):
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as pool:
+        futures = {pool.submit(run_job, path, timeout, memory_limit): path for path in paths}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                yield {'job': futures[future], 'ok': False, 'error': type(e).__name__}
+
+'''
+~~~~~~~~~~~~~~~~~~~~~~~~~ COMMAND LINE ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# the .crl and .json files named, and those in directories named
+def find_jobs(paths):
+    jobs = []
+    for path in paths:
+        if os.path.isdir(path):
+            jobs += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(('.crl', '.json')))
+        else:
+            jobs.append(path)
+    return jobs
+
+# usage: batch.py [--workers N] [--timeout SECONDS] [--memory-limit MB] path ...
+# writes the result of each job to stdout as a line of JSON once it finishes
+# exits with 1 if any job failed
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Run Carlae programs in parallel')
+    parser.add_argument('paths', nargs = '+', help = '.crl or .json files, or directories of them')
+    parser.add_argument('--workers', type = int, default = None, help = 'worker processes (default: one per CPU)')
+    parser.add_argument('--timeout', type = float, default = None, help = 'seconds each job may run for')
+    parser.add_argument('--memory-limit', type = float, default = None, help = 'MB of address space each worker may use')
+    args = parser.parse_args(argv)
+
+    memory_limit = None if args.memory_limit is None else int(args.memory_limit * (1 << 20))
+    failed = False
+    for result in run_batch(find_jobs(args.paths), args.workers, args.timeout, memory_limit):
+        failed = failed or not result['ok']
+        print(json.dumps(result), flush = True)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
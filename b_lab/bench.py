@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+import lab
+
+BENCH_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+'''
+~~~~~~~~~~~~~~~~~~~~~~~~~ BENCHMARK CASES ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# every case is a (name, setup) pair, where setup does the untimed work
+# (reading files, building inputs) and returns a function of no arguments
+# that runs the program being measured in a fresh environment
+
+# runs parsed expressions one after another in a fresh global environment,
+# carrying on after errors as test.py does
+def run_expressions(expressions):
+    env = lab.Environment()
+    for expression in expressions:
+        try:
+            lab.evaluate(expression, env)
+        except Exception:
+            pass
+
+# the first three test inputs exercise the reader instead of the evaluator
+READER_TESTS = {
+    1: lab.tokenize,
+    2: lab.parse,
+    3: lambda program: lab.parse(lab.tokenize(program)),
+}
+
+# runs a reader function on each input, carrying on after syntax errors
+def run_reader(func, inputs):
+    for program in inputs:
+        try:
+            func(program)
+        except SyntaxError:
+            pass
+
+def load_json(*path):
+    with open(os.path.join(BENCH_DIRECTORY, *path)) as f:
+        return json.load(f)
+
+# sorts file names by their number
+def numbered_files(directory, extension):
+    names = [name for name in os.listdir(os.path.join(BENCH_DIRECTORY, directory)) if name.endswith(extension)]
+    return sorted(names, key = lambda name: int(name[:-len(extension)]))
+
+def input_case(name):
+    number = int(name[:-len('.json')])
+    def setup():
+        inputs = load_json('test_inputs', name)
+        if number in READER_TESTS:
+            return lambda: run_reader(READER_TESTS[number], inputs)
+        return lambda: run_expressions(inputs)
+    return 'inputs/%s' % number, setup
+
+def crl_case(name):
+    def setup():
+        with open(os.path.join(BENCH_DIRECTORY, 'carlae_code', name)) as f:
+            program = f.read()
+        # reading the source is part of the measured work
+        return lambda: run_expressions(lab.read_expressions([program]))
+    return 'carlae_code/%s' % name[:-len('.crl')], setup
+
+def file_case(name):
+    def setup():
+        path = os.path.join(BENCH_DIRECTORY, 'test_files', name)
+        return lambda: lab.evaluate_file(path)
+    return 'test_files/%s' % name[:-len('.crl')], setup
+
+# cases built from the existing test corpus
+def corpus_cases():
+    cases = [input_case(name) for name in numbered_files('test_inputs', '.json')]
+    cases += [crl_case(name) for name in numbered_files('carlae_code', '.crl')]
+    names = sorted(name for name in os.listdir(os.path.join(BENCH_DIRECTORY, 'test_files')) if name.startswith('simple_test'))
+    cases += [file_case(name) for name in names]
+    return cases
+
+# parses each line of a program written as source text
+def read_program(*lines):
+    return lab.parse_program('\n'.join(lines))
+
+# synthetic programs stressing one part of the interpreter each, with
+# sizes multiplied by scale
+def synthetic_cases(scale):
+    def fib():
+        return lambda: run_expressions(read_program(
+            '(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))',
+            '(fib %d)' % (15 + scale)))
+
+    def tail_recursion():
+        return lambda: run_expressions(read_program(
+            '(define (count n acc) (if (=? n 0) acc (count (- n 1) (+ acc 1))))',
+            '(count %d 0)' % (50000 * scale)))
+
+    # recursion that is not in tail position, as deep as the default
+    # recursion limit allows
+    def deep_recursion():
+        return lambda: run_expressions(read_program(
+            '(define (sum-to n) (if (=? n 0) 0 (+ n (sum-to (- n 1)))))',
+            *['(sum-to %d)' % 150] * (20 * scale)))
+
+    def long_lists():
+        numbers = ['list'] + list(range(20000 * scale))
+        program = read_program(
+            '(define doubled (map (lambda (x) (* 2 x)) numbers))',
+            '(define evens (filter (lambda (x) (=? 0 (- x (* 2 (/ x 2))))) doubled))',
+            '(reduce (lambda (a b) (+ a b)) (concat evens numbers) 0)',
+            '(define (sum-at lst i acc) (if (=? i (length lst)) acc (sum-at lst (+ i 1) (+ acc (elt-at-index lst i)))))',
+            '(sum-at numbers 0 0)',
+            '(reduce + numbers 0)')
+        return lambda: run_expressions([['define', 'numbers', numbers]] + program)
+
+    # closures nested depth deep, each adding its own argument to a total
+    def big_scoping():
+        depth = 40
+        params = ['a%d' % i for i in range(depth)]
+        body = ['+'] + params
+        for param in reversed(params):
+            body = ['lambda', [param], body]
+        call = 'f'
+        for i in range(depth):
+            call = [call, i]
+        program = [['define', 'f', body]] + [call] * (50 * scale)
+        return lambda: run_expressions(program)
+
+    return [
+        ('synthetic/fib', fib),
+        ('synthetic/tail_recursion', tail_recursion),
+        ('synthetic/deep_recursion', deep_recursion),
+        ('synthetic/long_lists', long_lists),
+        ('synthetic/big_scoping', big_scoping),
+    ]
+
+'''
+~~~~~~~~~~~~~~~~~~~~~~~~~ MEASUREMENT ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# code objects of the closures made by the compiler's compile_ functions
+# each call of one of them is one evaluation step
+def compiled_codes():
+    codes = set()
+    pending = [func.__code__ for name, func in vars(lab).items() if name.startswith('compile_') and callable(func)]
+    while pending:
+        code = pending.pop()
+        for const in code.co_consts:
+            if isinstance(const, type(code)) and const not in codes:
+                codes.add(const)
+                pending.append(const)
+    return codes
+
+# number of compiled expressions run by run()
+# uses a profile hook, so the evaluator itself carries no counter
+def count_steps(run):
+    codes = compiled_codes()
+    steps = 0
+    def profiler(frame, event, arg):
+        nonlocal steps
+        if event == 'call' and frame.f_code in codes:
+            steps += 1
+    sys.setprofile(profiler)
+    try:
+        run()
+    finally:
+        sys.setprofile(None)
+    return steps
+
+# peak bytes allocated while running run()
+def peak_memory(run):
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# bytes of the most Frames alive at once while running run(), and the
+# number of Frames made
+# lab.Frame is swapped for a subclass that counts its instances, so frames
+# kept for reuse by Functions count as alive
+def frame_usage(run):
+    frame_class = lab.Frame
+    counts = {'made': 0, 'alive': 0, 'peak': 0}
+    class CountedFrame(frame_class):
+        __slots__ = ()
+
+        def __init__(self, values, parent):
+            frame_class.__init__(self, values, parent)
+            counts['made'] += 1
+            counts['alive'] += 1
+            counts['peak'] = max(counts['peak'], counts['alive'])
+
+        def __del__(self):
+            counts['alive'] -= 1
+    lab.Frame = CountedFrame
+    try:
+        run()
+    finally:
+        lab.Frame = frame_class
+    return counts['peak'] * sys.getsizeof(frame_class(None, None)), counts['made']
+
+# measures one case: the best wall time of repeat runs, then the peak
+# memory, frame usage and step count of separate runs, since tracing
+# slows them down
+def measure(setup, repeat):
+    times = []
+    for _ in range(repeat):
+        run = setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    frame_memory, frames = frame_usage(setup())
+    return {
+        'time': min(times),
+        'peak_memory': peak_memory(setup()),
+        'frame_memory': frame_memory,
+        'frames': frames,
+        'steps': count_steps(setup()),
+    }
+
+# runs every case whose name contains one of the patterns
+def run_benchmarks(patterns = (), scale = 1, repeat = 3, report = print):
+    results = {}
+    for name, setup in corpus_cases() + synthetic_cases(scale):
+        if patterns and not any(pattern in name for pattern in patterns):
+            continue
+        results[name] = measure(setup, repeat)
+        result = results[name]
+        report('%-28s %10.4f s %12d B %10d B in %8d frames %12d steps' % (name, result['time'], result['peak_memory'], result['frame_memory'], result['frames'], result['steps']))
+    return {
+        'python': platform.python_version(),
+        'scale': scale,
+        'repeat': repeat,
+        'cases': results,
+    }
+
+# cases whose time, peak memory, frame memory or steps in new exceed those
+# in base by more than threshold (a fraction), as (case, metric, base, new)
+# tuples
+# times under min_time seconds are too noisy to compare and are skipped, as
+# are metrics older result files do not have
+def find_regressions(base, new, threshold, min_time = 0.001):
+    regressions = []
+    for name, new_result in new['cases'].items():
+        base_result = base['cases'].get(name)
+        if base_result is None:
+            continue
+        for metric in ('time', 'peak_memory', 'frame_memory', 'steps'):
+            if metric not in base_result or metric not in new_result:
+                continue
+            if metric == 'time' and new_result[metric] < min_time:
+                continue
+            if new_result[metric] > base_result[metric] * (1 + threshold):
+                regressions.append((name, metric, base_result[metric], new_result[metric]))
+    return regressions
+
+# nanoseconds per call of a function of no arguments
+def time_per_call(func, number):
+    return min(timeit.repeat(func, number = number, repeat = 5)) / number * 1e9
+
+# sort-based comparison the builtins used to make, kept for reference
+def sorted_less_than(args):
+    sort_list = sorted(set(args))
+    return args == sort_list
+
+# per-call cost of comparisons and arithmetic: the builtins on their own,
+# and whole expressions run by the evaluator with one, two and four operands
+def comparison_microbenchmark(number = 100000):
+    env = lab.Environment()
+    lab.evaluate(['define', 'n', 5], env)
+    two = lab.compile_expression(['<', 'n', 2])
+    four = lab.compile_expression(['<', 1, 'n', 7, 9])
+    minus_one = lab.compile_expression(['-', 'n', 1])
+    negate = lab.compile_expression(['-', 'n'])
+    add_four = lab.compile_expression(['+', 1, 'n', 7, 9])
+    cases = [
+        ('sort-based < on 2 args', lambda: sorted_less_than([5, 2])),
+        ('sort-based < on 4 args', lambda: sorted_less_than([1, 5, 7, 9])),
+        ('builtin < on 2 args', lambda: lab.less_than([5, 2])),
+        ('builtin < on 4 args', lambda: lab.less_than([1, 5, 7, 9])),
+        ('two-argument <', lambda: lab.binary_builtins[lab.less_than](5, 2)),
+        ('evaluated (< n 2)', lambda: two(env)),
+        ('evaluated (< 1 n 7 9)', lambda: four(env)),
+        ('builtin - on 2 args', lambda: lab.sub([5, 1])),
+        ('two-argument -', lambda: lab.binary_builtins[lab.sub](5, 1)),
+        ('evaluated (- n 1)', lambda: minus_one(env)),
+        ('evaluated (- n)', lambda: negate(env)),
+        ('evaluated (+ 1 n 7 9)', lambda: add_four(env)),
+    ]
+    return [(name, time_per_call(func, number)) for name, func in cases]
+
+# carlae source text of a parsed expression
+def source_text(parsed):
+    if isinstance(parsed, list):
+        return '(' + ' '.join(source_text(term) for term in parsed) + ')'
+    return str(parsed)
+
+# bytes kept allocated by the value load() returns, and that value
+def retained_memory(load):
+    tracemalloc.start()
+    try:
+        value = load()
+        return tracemalloc.get_traced_memory()[0], value
+    finally:
+        tracemalloc.stop()
+
+# (occurrences, distinct objects) of the atoms in parsed expressions
+def count_atoms(expressions):
+    occurrences = 0
+    objects = set()
+    pending = list(expressions)
+    while pending:
+        parsed = pending.pop()
+        if isinstance(parsed, list):
+            pending.extend(parsed)
+        else:
+            occurrences += 1
+            objects.add(id(parsed))
+    return occurrences, len(objects)
+
+# memory held by the expressions of the test_inputs corpus, as loaded from
+# JSON, where every atom is an object of its own, and as read from their
+# source by the reader, which interns symbols and shares equal numbers
+# returns (name, bytes, atoms, distinct atom objects) for each
+def parse_memory_report():
+    names = [name for name in numbered_files('test_inputs', '.json') if int(name[:-len('.json')]) not in READER_TESTS]
+    sources = [source_text(expression) for name in names for expression in load_json('test_inputs', name)]
+    def from_json():
+        return [load_json('test_inputs', name) for name in names]
+    def from_source():
+        return [lab.parse_program(source) for source in sources]
+    report = []
+    for name, load in [('test_inputs as JSON', from_json), ('test_inputs read from source', from_source)]:
+        size, programs = retained_memory(load)
+        report.append((name, size) + count_atoms(programs))
+    return report
+
+'''
+~~~~~~~~~~~~~~~~~~~~~~~~~ COMMAND LINE ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# usage:
+#   bench.py run [-o results.json] [--scale N] [--repeat N] [pattern ...]
+#   bench.py compare base.json new.json [--threshold 0.1] [--min-time 0.001]
+#   bench.py micro
+#   bench.py memory
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Carlae interpreter benchmarks')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    run_parser = commands.add_parser('run', help = 'run benchmark cases and write their results as JSON')
+    run_parser.add_argument('patterns', nargs = '*', help = 'only run cases whose name contains one of these')
+    run_parser.add_argument('-o', '--output', default = 'bench_results.json')
+    run_parser.add_argument('--scale', type = int, default = 1, help = 'size multiplier for synthetic cases')
+    run_parser.add_argument('--repeat', type = int, default = 3, help = 'timed runs per case; the fastest is kept')
+    compare_parser = commands.add_parser('compare', help = 'flag regressions between two result files')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type = float, default = 0.1, help = 'allowed increase, as a fraction')
+    compare_parser.add_argument('--min-time', type = float, default = 0.001, help = 'ignore times below this many seconds')
+    commands.add_parser('micro', help = 'per-call cost of the comparison and arithmetic builtins')
+    commands.add_parser('memory', help = 'memory held by the parsed test_inputs corpus')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        results = run_benchmarks(args.patterns, args.scale, args.repeat)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
+        return 0
+    if args.command == 'compare':
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        regressions = find_regressions(base, new, args.threshold, args.min_time)
+        for name, metric, base_val, new_val in regressions:
+            print('%-28s %-12s %12.4g -> %12.4g (%+.0f%%)' % (name, metric, base_val, new_val, (new_val / base_val - 1) * 100 if base_val else float('inf')))
+        print('%d regression(s) beyond %.0f%%' % (len(regressions), args.threshold * 100))
+        return 1 if regressions else 0
+    if args.command == 'memory':
+        for name, size, atoms, objects in parse_memory_report():
+            print('%-30s %10d B %8d atoms %8d distinct' % (name, size, atoms, objects))
+        return 0
+    for name, cost in comparison_microbenchmark():
+        print('%-28s %8.1f ns' % (name, cost))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
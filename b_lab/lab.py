@@ -1,25 +1,144 @@
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import marshal
+import math
+import operator
+import os
+import re
 import sys
+import threading
+import time
+
+# numpy is optional, and only speeds up builtins applied to long lists of ints
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # custom exception 
 class EvaluationError(Exception):
     pass
 
+# raised when an evaluation uses up part of its Budget
+class ResourceLimitExceeded(EvaluationError):
+    def __init__(self, resource):
+        super().__init__('evaluation exceeded its %s limit' % resource)
+        # 'steps', 'time', 'cells' or 'depth'
+        self.resource = resource
+
 '''
 ~~~~~~~~~~~~~~~~~~~~~~~~~ PROGRAM PREPROCESSING ~~~~~~~~~~~~~~~~~~~~~~~~~
 '''
 
+# single token: a parenthesis or a run of characters that are not
+# whitespace, parentheses or the start of a comment
+TOKEN_PATTERN = re.compile(r'[()]|[^\s();]+|;[^\n]*')
+
+# same as TOKEN_PATTERN, but also matches newlines to track line numbers
+POSITIONED_TOKEN_PATTERN = re.compile(r'[()]|[^\s();]+|;[^\n]*|\n')
+
 # splits a program into its tokens 
 def tokenize(program):
-    # split program into lines to handle comments 
-    program_lines = program.split('\n')
-    # removing comments
-    for cur_index, line in enumerate(program_lines):
-        if ';' in line:
-            program_lines[cur_index] = line[:line.index(';')]
-    # recombining lines into single string
-    single_program = ' '.join(program_lines)
-    # spacing parentheses to help with parsing
-    return single_program.replace('(', ' ( ').replace(')', ' ) ').split()
+    # comments match as their own token and are dropped
+    return [token for token in TOKEN_PATTERN.findall(program) if token[0] != ';']
+
+# parsed list expression that remembers where it began in the source
+class Expression(list):
+    __slots__ = ('line', 'column')
+
+# ascii characters that no number begins with
+# numbers begin with a digit, a sign or a decimal point
+SYMBOL_INITIALS = frozenset(chr(code) for code in range(128)) - frozenset('0123456789+-.')
+
+# converts a single token into a number if possible
+# symbols are interned, so every occurrence of a name in every program
+# parsed is the same string object, and comparing two of them only
+# compares their identity
+def parse_atom(token):
+    # most symbols are told apart by their first character, without trying
+    # and failing to convert them
+    if token[0] in SYMBOL_INITIALS or (len(token) == 1 and not token.isdigit()):
+        return sys.intern(token)
+    try:
+        # decimal value
+        if '.' in token:
+            return float(token)
+        # int value
+        return int(token)
+    except ValueError:
+        return sys.intern(token)
+
+# formats a source position for error messages
+def describe_position(line, column):
+    return ' at line %s, column %s' % (line, column)
+
+# reads an open file in chunks of roughly chunk_size characters, each
+# ending on a line boundary so no token or comment is split between chunks
+def read_chunks(file, chunk_size = 1 << 16):
+    # pieces of the current line not yet followed by a newline
+    pending = []
+    for chunk in iter(lambda: file.read(chunk_size), ''):
+        cut = chunk.rfind('\n') + 1
+        if not cut:
+            pending.append(chunk)
+            continue
+        pending.append(chunk[:cut])
+        yield ''.join(pending)
+        pending = [chunk[cut:]]
+    yield ''.join(pending)
+
+# tokenizes and parses program source in a single pass, yielding every
+# complete top-level expression as soon as it is closed
+# the source is given as an iterable of chunks that each end on a line
+# boundary, and only the expression being read is kept in memory
+# uses an explicit stack, so nesting depth is not limited by python's
+# recursion limit, and records the line and column (from 1) of each list
+def read_expressions(chunks):
+    # open expressions, innermost last
+    stack = []
+    # converted atoms by token, so repeated atoms are converted once and
+    # equal numbers share one object
+    atoms = {}
+    line = 1
+    for chunk in chunks:
+        # offset where the current line begins
+        line_start = 0
+        for match in POSITIONED_TOKEN_PATTERN.finditer(chunk):
+            token = match.group()
+            if token == '(':
+                expression = Expression()
+                expression.line = line
+                expression.column = match.start() - line_start + 1
+                stack.append(expression)
+            elif token == ')':
+                if not stack:
+                    column = match.start() - line_start + 1
+                    raise SyntaxError('unexpected ")"' + describe_position(line, column))
+                finished = stack.pop()
+                if stack:
+                    stack[-1].append(finished)
+                else:
+                    yield finished
+            elif token == '\n':
+                line += 1
+                line_start = match.end()
+            elif token[0] != ';':
+                atom = atoms.get(token)
+                if atom is None:
+                    atom = atoms[token] = parse_atom(token)
+                if stack:
+                    stack[-1].append(atom)
+                else:
+                    yield atom
+    # raise error if an expression was never closed
+    if stack:
+        raise SyntaxError('missing ")"' + describe_position(stack[-1].line, stack[-1].column))
+
+# parses every top-level expression of a program's source
+def parse_program(program):
+    return list(read_expressions([program]))
 
 # determines if function is valid
 def is_valid_parse(tokens):
@@ -35,53 +154,32 @@ def is_valid_parse(tokens):
             return False
     return open_p == 0
 
-# splits tokens into sub environments
-# assumes valid program
-def parsing(tokens):
-    initial_token = tokens.pop(0)
-    # if token is single value
-    if not tokens:
-        # if numerical value
-        try:
-            # decimal value
-            if '.' in initial_token:
-                cur_num = float(initial_token)
-            # int value
-            else:
-                cur_num = int(initial_token)
-            return cur_num
-        except:
-            return initial_token
-    # current environment 
-    cur_list = []
-    # continue parsing until end of current environment
-    while tokens[0] != ')':
-        # beginning of new subexpression
-        if tokens[0] == '(':
-            # append parsed subexpression
-            cur_list.append(parsing(tokens))
-        # continuously add components of current environment to parsed list
-        else:
-            cur_token = tokens.pop(0)
-            try:
-                if '.' in cur_token:
-                    cur_num = float(cur_token)
-                else:
-                    cur_num = int(cur_token)
-                cur_list.append(cur_num)
-            except:
-                cur_list.append(cur_token)
-    # remove close parentheses
-    tokens.pop(0)
-    # return parsed list of current environment
-    return cur_list
-
 # parse container function
+# walks the tokens once with a cursor and returns the first expression
 def parse(tokens):
     # raise error if invalid program
-    if not is_valid_parse(tokens):
+    if not is_valid_parse(tokens) or not tokens:
         raise SyntaxError
-    return parsing(tokens)
+    # open expressions, innermost last
+    stack = []
+    # converted atoms by token, so repeated atoms are converted once and
+    # equal numbers share one object
+    atoms = {}
+    for token in tokens:
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            finished = stack.pop()
+            if not stack:
+                return finished
+            stack[-1].append(finished)
+        else:
+            atom = atoms.get(token)
+            if atom is None:
+                atom = atoms[token] = parse_atom(token)
+            if not stack:
+                return atom
+            stack[-1].append(atom)
 
 '''
 ~~~~~~~~~~~~~~~~~~~~~~~~~ BUILT-IN FUNCTION DEFINITIONS ~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -108,6 +206,8 @@ def div(args):
             temp /= val
         return temp
 
+# comparisons check each neighbouring pair once, stopping at the first
+# pair that fails
 def equals(args):
     for i in args[1:]:
         if i != args[0]:
@@ -115,37 +215,60 @@ def equals(args):
     return True
 
 def greater_than(args):
-    sort_list = sorted(set(args), reverse = True)
-    return args == sort_list
+    prev = args[0] if args else None
+    for val in args[1:]:
+        if not prev > val:
+            return False
+        prev = val
+    return True
 
 def greater_than_equal(args):
-    sort_list = sorted(args, reverse = True)
-    return args == sort_list
+    prev = args[0] if args else None
+    for val in args[1:]:
+        if not prev >= val:
+            return False
+        prev = val
+    return True
 
 def less_than(args):
-    sort_list = sorted(set(args))
-    return args == sort_list
+    prev = args[0] if args else None
+    for val in args[1:]:
+        if not prev < val:
+            return False
+        prev = val
+    return True
 
 def less_than_equal(args):
-    sort_list = sorted(args)
-    return args == sort_list
+    prev = args[0] if args else None
+    for val in args[1:]:
+        if not prev <= val:
+            return False
+        prev = val
+    return True
 
 def not_op(args):
     return not args[0]
 
-def list_init(args):
-    if args == []:
+# builds a list from a tuple of elements
+# lists of ints are packed into a NumberList
+def make_list(elts):
+    if not elts:
         return None
-    next_list = list_init(args[1:])
-    return LinkedList(args[0], next_list)
+    if all(type(x) is int for x in elts):
+        return NumberList(elts)
+    return LinkedList(elts)
+
+def list_init(args):
+    # tuple() returns tuples as they are
+    return make_list(tuple(args))
 
 def car(args):
-    if args[0] == None:
+    if args[0] is None:
         raise EvaluationError
     return args[0].elt
 
 def cdr(args):
-    if args[0] == None:
+    if args[0] is None:
         raise EvaluationError
     return args[0].next
 
@@ -157,54 +280,335 @@ def list_len(args):
 def elt_at_ind(args):
     my_list = args[0]
     index = args[1]
-    if my_list == None:
+    if my_list is None:
         raise EvaluationError
     return my_list[index]
 
+# copies the elements of every list but the last into the tuple of a new
+# list, which continues with the last list itself
+# lists are immutable, so sharing it is safe, and adding elements to the
+# front of a list costs nothing for the elements already in it
 def concatenate(args):
+    # skip empty lists
+    lists = [concat_list for concat_list in args if concat_list is not None]
     # empty list
-    if args == []:
+    if not lists:
         return None
-    # single list
-    if len(args) == 1:
-        return args[0].copy()
-    else:
-        # fake empty list for concat compatibility
-        head = LinkedList('None', None)
-        for concat_list in args:
-            # skip empty lists
-            if concat_list == None:
-                continue
-            head.concat(concat_list)
-        return head
+    last = lists[-1]
+    if not all(isinstance(concat_list, LinkedList) for concat_list in lists):
+        return make_list(tuple(itertools.chain.from_iterable(lists)))
+    if len(lists) == 1:
+        return last
+    items = tuple(itertools.chain.from_iterable(lists[:-1]))
+    if type(last) is NumberList and all(type(x) is int for x in items):
+        return NumberList(items, 0, last)
+    return LinkedList(items, 0, last)
 
+# map, filter and reduce run builtins given to them on a NumberList as
+# one bulk operation instead of one call per element
 def map_fun(args):
     func = args[0]
     params = args[1]
-    # fake empty list for concat compatibility
-    out_list = LinkedList('None', None)
-    for x in params:
-        out_list.concat(list_init([func([x])]))
-    return out_list
+    if type(params) is NumberList and func in number_maps:
+        return number_maps[func](params)
+    return make_list(tuple(func([x]) for x in params))
 
 def filter_fun(args):
     func = args[0]
     params = args[1]
-    # fake empty list for concat compatibility
-    out_list = LinkedList('None', None)
-    for x in params:
-        if func([x]):
-            out_list.concat(list_init([x]))
-    return out_list
+    if type(params) is NumberList and func in number_filters:
+        return number_filters[func](params)
+    return make_list(tuple(x for x in params if func([x])))
 
 def reduce_fun(args):
     func = args[0]
     params = args[1]
     out_val = args[2]
+    if type(params) is NumberList and type(out_val) is int and func in number_reductions:
+        return number_reductions[func](params, out_val)
     for x in params:
         out_val = func([out_val, x])
     return out_val
 
+# number of calls a memoized function remembers unless given a size
+MEMOIZE_SIZE = 1024
+
+# (memoize f) or (memoize f size)
+# function returning the same values as f, that remembers the values of
+# its size most recently used distinct calls
+def memoize(args):
+    if len(args) not in (1, 2) or not callable(args[0]):
+        raise EvaluationError
+    max_size = args[1] if len(args) == 2 else MEMOIZE_SIZE
+    if type(max_size) is not int or max_size < 1:
+        raise EvaluationError
+    return MemoizedFunction(args[0], max_size)
+
+# hashable value that is equal for equal carlae values
+# numbers of different types stay apart, since they can give different
+# results, and lists are compared by their elements
+def memo_key(value):
+    value_type = type(value)
+    if value_type is int:
+        return value
+    if value_type is NumberList:
+        return (LinkedList, tuple(value))
+    if value_type is LinkedList:
+        return (LinkedList, tuple(memo_key(elt) for elt in value))
+    return (value_type, value)
+
+'''
+~~~~~~~~~~~~~~~~~~~~~~~~~ BULK OPERATIONS ON LISTS OF INTS ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# each of these gives exactly the result of calling the builtin on every
+# element (or on the running value and every element, for reduce), using
+# numpy when it is installed and the values cannot overflow, and python's
+# own bulk functions otherwise
+# builtins called with one argument behave as follows:
+#   (+ x) and (* x) are x, (- x) is -x, (/ x) is 1, comparisons are #t
+
+def map_same(numbers):
+    return NumberList(numbers.items, numbers.start, numbers.rest, numbers.packing)
+
+def map_negate(numbers):
+    packed = numbers.packed()
+    if packed is not None:
+        array, bound = packed
+        return NumberList(tuple((-array).tolist()))
+    return NumberList(tuple(map(operator.neg, numbers)))
+
+def map_one(numbers):
+    return NumberList((1,) * len(numbers))
+
+def map_true(numbers):
+    return LinkedList((True,) * len(numbers))
+
+def map_not(numbers):
+    return LinkedList(tuple(map(operator.not_, numbers)))
+
+def filter_nonzero(numbers):
+    packed = numbers.packed()
+    if packed is not None:
+        array, bound = packed
+        return make_list(tuple(array[array != 0].tolist()))
+    return make_list(tuple(filter(None, numbers)))
+
+def filter_zero(numbers):
+    return make_list(tuple(x for x in numbers if not x))
+
+def reduce_sum(numbers, out_val):
+    packed = numbers.packed()
+    if packed is not None:
+        array, bound = packed
+        # the int64 sum cannot overflow
+        if len(array) * bound < 1 << 63:
+            return out_val + int(array.sum())
+    return sum(numbers, out_val)
+
+def reduce_sub(numbers, out_val):
+    return out_val - reduce_sum(numbers, 0)
+
+def reduce_mult(numbers, out_val):
+    return math.prod(numbers, start = out_val)
+
+number_maps = {
+    sum: map_same,
+    mult: map_same,
+    sub: map_negate,
+    div: map_one,
+    equals: map_true,
+    greater_than: map_true,
+    greater_than_equal: map_true,
+    less_than: map_true,
+    less_than_equal: map_true,
+    not_op: map_not,
+}
+
+number_filters = {
+    sum: filter_nonzero,
+    sub: filter_nonzero,
+    mult: filter_nonzero,
+    div: map_same,
+    equals: map_same,
+    greater_than: map_same,
+    greater_than_equal: map_same,
+    less_than: map_same,
+    less_than_equal: map_same,
+    not_op: filter_zero,
+}
+
+number_reductions = {
+    sum: reduce_sum,
+    sub: reduce_sub,
+    mult: reduce_mult,
+}
+
+'''
+~~~~~~~~~~~~~~~~~~~~~~~~~ PARALLEL MAP ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# (pmap f list) gives the same list as (map f list), but applies f to
+# chunks of long lists on a pool of worker processes
+# compiled code cannot be sent between processes, so f is sent as its
+# parameters and parsed body, with the value of each name it reads from
+# where it was defined, and compiled again by the worker
+# the work stays in this process for short lists, builtins, functions
+# that use set! or read functions that do (their state would not be shared
+# with the workers), values that cannot be sent, like memoized functions,
+# and evaluations with a Budget, which workers could not charge
+
+# number of worker processes, and the shortest list sent to them
+PMAP_WORKERS = os.cpu_count() or 1
+PMAP_MIN_LENGTH = 2000
+
+# pool of worker processes, started by the first pmap that needs it
+pmap_pool = None
+# true in the worker processes, where pmap always works in place
+pmap_worker = False
+
+# raised for values that cannot be sent to another process
+class CannotShip(Exception):
+    pass
+
+# Function as sent to another process
+class ShippedFunction():
+    __slots__ = ('params', 'body', 'captures')
+
+    def __init__(self, params, body, captures):
+        self.params = params
+        # parsed body
+        self.body = body
+        # shipped value of each name the body reads from its environment
+        self.captures = captures
+
+# list as sent to another process
+class ShippedList():
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        # tuple of shipped elements
+        self.items = items
+
+# adds every symbol appearing in parsed to names
+def add_symbols(parsed, names):
+    pending = [parsed]
+    while pending:
+        parsed = pending.pop()
+        if isinstance(parsed, list):
+            pending.extend(parsed)
+        elif isinstance(parsed, str):
+            names.add(parsed)
+        elif isinstance(parsed, Folded):
+            pending.append(parsed.expression)
+            pending.append(parsed.original)
+
+# value of name in env, a frame described by scope or an Environment
+def look_up(env, scope, name):
+    if scope is None:
+        return env[name]
+    addresses, depth = scope.resolve(name)
+    return lookup_slow(env, addresses, depth, name)
+
+# copy of value that can be pickled, made of plain values, builtins,
+# ShippedLists and ShippedFunctions
+# memo holds the ShippedFunction of each function already shipped, so
+# recursive functions are only shipped once
+def ship(value, memo):
+    value_type = type(value)
+    if value is None or value_type in (int, float, bool):
+        return value
+    if value_type is NumberList:
+        return ShippedList(tuple(value))
+    if value_type is LinkedList:
+        return ShippedList(tuple(ship(elt, memo) for elt in value))
+    if value_type is Function or value_type is VMFunction:
+        return ship_function(value, memo)
+    if callable(value) and value in carlae_builtins.values():
+        return value
+    raise CannotShip
+
+def ship_function(function, memo):
+    if id(function) in memo:
+        return memo[id(function)]
+    names = set()
+    add_symbols(function.function, names)
+    if 'set!' in names:
+        raise CannotShip
+    shipped = memo[id(function)] = ShippedFunction(tuple(function.params), function.function, {})
+    for name in names.difference(function.params, special_forms):
+        try:
+            value = look_up(function.env, function.scope, name)
+        # names only bound inside the body itself
+        except EvaluationError:
+            continue
+        if carlae_builtins.get(name, UNBOUND) is not value:
+            shipped.captures[name] = ship(value, memo)
+    return shipped
+
+# value made again from its shipped copy
+# shipped functions become Functions defined in an Environment of their own
+def unship(value, memo):
+    value_type = type(value)
+    if value_type is ShippedList:
+        return make_list(tuple(unship(elt, memo) for elt in value.items))
+    if value_type is ShippedFunction:
+        if id(value) in memo:
+            return memo[id(value)]
+        env = Environment()
+        function = memo[id(value)] = Function(value.params, value.body, env)
+        for name, captured in value.captures.items():
+            env[name] = unship(captured, memo)
+        return function
+    return value
+
+def start_pmap_worker():
+    global pmap_worker
+    pmap_worker = True
+
+# runs in a worker: applies a shipped function to a chunk of shipped
+# elements, returning the shipped results, or None if they cannot be sent
+def pmap_chunk(shipped, chunk):
+    memo = {}
+    function = unship(shipped, memo)
+    results = [function([unship(elt, memo)]) for elt in chunk]
+    try:
+        return [ship(result, {}) for result in results]
+    except CannotShip:
+        return None
+
+def get_pmap_pool():
+    global pmap_pool
+    if pmap_pool is None:
+        pmap_pool = concurrent.futures.ProcessPoolExecutor(PMAP_WORKERS, initializer = start_pmap_worker)
+    return pmap_pool
+
+def pmap(args):
+    global pmap_pool
+    func = args[0]
+    params = args[1]
+    if (pmap_worker or PMAP_WORKERS < 2 or limit_state.budget is not None or type(func) not in (Function, VMFunction)
+            or not isinstance(params, LinkedList) or len(params) < PMAP_MIN_LENGTH):
+        return map_fun(args)
+    memo = {}
+    try:
+        shipped = ship(func, memo)
+        items = tuple(ship(elt, memo) for elt in params)
+    except (CannotShip, RecursionError):
+        return map_fun(args)
+    # a few chunks per worker, so uneven chunks still keep every worker busy
+    chunk_size = -(-len(items) // (PMAP_WORKERS * 4))
+    chunks = [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+    try:
+        results = list(get_pmap_pool().map(pmap_chunk, [shipped] * len(chunks), chunks))
+    except concurrent.futures.process.BrokenProcessPool:
+        pmap_pool = None
+        return map_fun(args)
+    if any(result is None for result in results):
+        return map_fun(args)
+    memo = {}
+    return make_list(tuple(unship(value, memo) for result in results for value in result))
+
 # base operator dictionary
 carlae_builtins = {
     '+': sum,
@@ -228,14 +632,41 @@ carlae_builtins = {
     'map': map_fun,
     'filter': filter_fun,
     'reduce': reduce_fun,
+    'memoize': memoize,
+    'pmap': pmap,
+}
+
+# two-argument versions of builtins, called directly with both values by
+# call sites that have exactly two operands
+# the arithmetic ones match the variadic builtins on two values: sum starts
+# from 0 and mult from 1, which change nothing a second operand does not
+binary_builtins = {
+    sum: operator.add,
+    sub: operator.sub,
+    mult: operator.mul,
+    div: operator.truediv,
+    equals: operator.eq,
+    greater_than: operator.gt,
+    greater_than_equal: operator.ge,
+    less_than: operator.lt,
+    less_than_equal: operator.le,
+}
+
+# one-argument versions of builtins, for call sites with a single operand
+# only negation is common enough to need one: (- x)
+unary_builtins = {
+    sub: operator.neg,
 }
 
 ''' 
 ~~~~~~~~~~~~~~~~~~~~~~~~~ HELPER CLASSES ~~~~~~~~~~~~~~~~~~~~~~~~~
 '''
 
-# representation of environments 
+# representation of global environments, whose symbols can be defined
+# at any time and are looked up by name
 class Environment():
+    __slots__ = ('parent', 'symbols')
+
     def __init__(self, parent = carlae_builtins):
         # parent environments for recursive symbol retrieval
         self.parent = parent
@@ -243,248 +674,1937 @@ class Environment():
         self.symbols = {}
 
     # defining symbol in current env
+    # builtins it shadows are recorded, so folded code stops relying on them,
+    # and the values of key cached by compiled code are made stale
     def __setitem__(self, key, val):
+        if key in carlae_builtins and key not in builtin_shadows.names:
+            builtin_shadows.add(key)
         self.symbols[key] = val
+        version = name_versions.get(key)
+        if version is not None:
+            version.number = next(version_numbers)
     
     # retrieving value of symbol
     def __getitem__(self, key):
-        # check current env's symbol table
-        if key in self.symbols:
-            return self.symbols[key]
-        # check parent env if is not carlae_builtins
-        elif self.parent != carlae_builtins:
-            return self.parent[key]
+        env = self
+        # check each env's symbol table until reaching carlae_builtins
+        while env is not carlae_builtins:
+            symbols = env.symbols
+            if key in symbols:
+                return symbols[key]
+            env = env.parent
         # check carlae_builtins
-        else:
-            if key in carlae_builtins:
-                return carlae_builtins[key]
-            else:
-                raise EvaluationError
+        if key in carlae_builtins:
+            return carlae_builtins[key]
+        raise EvaluationError
+
+# version of a global name whose value compiled code caches, renumbered
+# after every define or set! of the name in any Environment
+# numbers are never reused, so a number read before a change can never
+# match after it, whichever thread makes the change
+class NameVersion():
+    __slots__ = ('number',)
+
+    def __init__(self):
+        self.number = next(version_numbers)
+
+version_numbers = itertools.count()
+
+# NameVersion of each name that is cached
+name_versions = {}
+
+# marks frame slots whose name has not been defined yet
+UNBOUND = object()
+
+# representation of the environment of a function call or let expression
+# every name the frame can hold is known when its code is compiled, so
+# values are stored by slot index instead of by name
+class Frame():
+    __slots__ = ('values', 'parent')
+
+    def __init__(self, values, parent):
+        # value of each slot, or UNBOUND
+        self.values = values
+        # enclosing Frame, or the Environment the code was compiled in
+        self.parent = parent
+
+# most Frames kept for reuse by each Function whose frames cannot escape
+FRAME_POOL_SIZE = 64
 
 # representation of function information
 class Function():  
-    def __init__(self, params, function, env):
-        # list of parameters for function
+    def __init__(self, params, function, env, code = None, frame_size = None, scope = None, escapes = None):
+        # sequence of parameters for function
         self.params = params
         # code for execution of function
         self.function = function
         # env where function was defined
         self.env = env
+        # Scope describing env, or None if env is an Environment
+        self.scope = scope
+        # compiled body, shared by every function made from the same lambda
+        # functions built directly from python must be defined in an Environment
+        if code is None:
+            code, frame_size = compile_function(params, function, None)
+        self.code = code
+        # slots after the parameters, for names defined in the body
+        self.padding = [UNBOUND] * (frame_size - len(params))
+        # finished Frames to run later calls in, or None if a call's frame
+        # may be kept by a lambda made in the body (see frame_escapes)
+        if escapes is None:
+            escapes = frame_escapes(function)
+        self.frames = None if escapes else []
 
     # calling functions
+    # calls in tail position of the body come back as TailCall and are run
+    # in this loop, so tail recursion does not grow the python stack
+    # with a Budget, every run of a body is charged to it, and the call
+    # runs one level deeper, however the function was compiled
+    # the body run then is compiled for the Budget, so the builtins it calls
+    # are charged too
     def __call__(self, params):
-        # if number of params is not correct
-        if len(self.params) != len(params):
-            raise EvaluationError
-        # temporary environment for parameter name mapping
-        cur_env = Environment(self.env)
-        # mapping parameters to function passed arguments
-        for i, var in enumerate(self.params):
-            cur_env[var] = params[i]
-        # calling function in sub environment
-        return result_and_env(self.function, cur_env)[0]
+        function = self
+        budget = limit_state.budget
+        if budget is not None:
+            budget.enter()
+        try:
+            while True:
+                # if number of params is not correct
+                if len(function.params) != len(params):
+                    raise EvaluationError
+                # the passed arguments fill the parameter slots of the new frame
+                if function.padding:
+                    params = params + function.padding
+                # calling function in sub environment
+                # frames that nothing can reach once the body returns are put
+                # back in the pool, without the arguments they held
+                # another thread may empty the pool at any time, so it is
+                # popped without checking it first
+                frames = function.frames
+                if frames is None:
+                    frame = Frame(params, function.env)
+                else:
+                    try:
+                        frame = frames.pop()
+                        frame.values = params
+                    except IndexError:
+                        frame = Frame(params, function.env)
+                if budget is None:
+                    result = function.code(frame)
+                else:
+                    result = metered_code(function)(frame)
+                if frames is not None and len(frames) < FRAME_POOL_SIZE:
+                    frame.values = None
+                    frames.append(frame)
+                if type(result) is not TailCall:
+                    return result
+                function = result.function
+                params = result.params
+                if budget is not None:
+                    budget.step()
+        finally:
+            if budget is not None:
+                budget.depth -= 1
+
+# body of function compiled to charge the builtins it calls to the current
+# Budget
+# made the first time a budgeted evaluation runs a function of its lambda,
+# and kept on the lambda's compiled body for the others
+def metered_code(function):
+    code = function.code
+    metered = getattr(code, 'metered', None)
+    if metered is None:
+        previous = getattr(compile_state, 'metered', False)
+        compile_state.metered = True
+        try:
+            metered = compile_function(function.params, function.function, function.scope)[0]
+        finally:
+            compile_state.metered = previous
+        code.metered = metered
+    return metered
+
+# function made by the memoize builtin
+class MemoizedFunction():
+    def __init__(self, function, max_size):
+        # function being memoized
+        self.function = function
+        self.max_size = max_size
+        # value of each remembered call by the memo_key of its arguments,
+        # least recently used first
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # calls that raise an error are not remembered
+    def __call__(self, params):
+        key = tuple(memo_key(param) for param in params)
+        cache = self.cache
+        if key in cache:
+            self.hits += 1
+            cache.move_to_end(key)
+            return cache[key]
+        self.misses += 1
+        value = self.function(params)
+        cache[key] = value
+        if len(cache) > self.max_size:
+            cache.popitem(last = False)
+        return value
+
+    # hit and miss counts, and the maximum and current number of calls
+    # remembered
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'max_size': self.max_size, 'size': len(self.cache)}
+
+    def cache_clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+# pending call to a Function, returned from tail position of a body
+class TailCall():
+    __slots__ = ('function', 'params')
+
+    def __init__(self, function, params):
+        self.function = function
+        self.params = params
 
 # representation of lists
+# a non-empty, immutable view of items from index start onwards, followed
+# by the elements of the list rest, so cdr shares the items of its list
+# and concat shares the cells of its last list
+# length is O(1), and indexing is O(1) within the first items and O(1)
+# more for each list it steps over
+# the empty list is None
+# most lists walked by an index before a list with a rest is flattened
+CHAIN_WALK_LIMIT = 8
+
 class LinkedList():
-    def __init__(self, elt, next):
-        # current value
-        self.elt = elt
-        # pointer to next list node
-        self.next = next
-
-    # concatenation function
-    def concat(self, new_list):
-        # custom case for concatenating to empty list
-        if self.elt == 'None':
-            self.elt = new_list.elt
-            self.next = new_list.next
-        # adding copy to tail
-        else:
-            my_tail = self.get_tail()
-            my_tail.next = new_list.copy()
-
-    # returns tail of list 
-    # assumes non-empty list
-    def get_tail(self):
-        current = self
-        if current.next == None:
-            return self
-        while current.next != None:
-            current = current.next
-        return current
-
-    # returns duplicate of current list
-    # used in concatenation
-    def copy(self):
-        if self.elt == 'None':
-            return LinkedList('None', None)
-        cur_elt = self.elt
-        next_list = None if self.next == None else self.next.copy()
-        return LinkedList(cur_elt, next_list)
+    __slots__ = ('items', 'start', 'rest', 'size', 'flat')
+
+    def __init__(self, items, start = 0, rest = None):
+        # tuple of elements, shared by every view of the same list
+        self.items = items
+        # index of this view's first element
+        self.start = start
+        # list continuing after items, or None
+        self.rest = rest
+        # number of elements, including those of rest
+        self.size = len(items) - start + (rest.size if rest is not None else 0)
+        # tuple of every element, made once indexing would walk too many
+        # lists of the chain, or None
+        self.flat = None
+
+    # current value
+    @property
+    def elt(self):
+        return self.items[self.start]
+
+    # rest of the list, or None at the last element
+    @property
+    def next(self):
+        if self.flat is not None:
+            return LinkedList(self.flat, 1) if self.size > 1 else None
+        start = self.start + 1
+        if start == len(self.items):
+            return self.rest
+        return LinkedList(self.items, start, self.rest)
 
     # ensures iterability
     def __iter__(self):
-        current = self
-        while current != None:
-            yield current.elt
-            current = current.next
+        if self.rest is not None:
+            return itertools.chain.from_iterable(self.chunks())
+        if self.start:
+            return itertools.islice(self.items, self.start, None)
+        return iter(self.items)
+
+    # the elements of each list making up this one, in order
+    def chunks(self):
+        node = self
+        while node is not None:
+            yield itertools.islice(node.items, node.start, None) if node.start else node.items
+            node = node.rest
 
     # simplifies recursive symbol fetching
+    # a chain of many lists, such as one built by prepending with concat,
+    # is flattened the first time an index would walk far into it, so
+    # indexing stays O(1)
     def __getitem__(self, index):
-        current = self
-        if len(self) == 0 or index >= len(self) or index < 0:
+        if index >= self.size or index < 0:
             raise EvaluationError
-        for i in range(index):
-            current = current.next
-        return current.elt
+        flat = self.flat
+        if flat is not None:
+            return flat[index]
+        position = index
+        node = self
+        index += node.start
+        walked = 0
+        while index >= len(node.items):
+            walked += 1
+            if walked > CHAIN_WALK_LIMIT:
+                flat = self.flat = tuple(self)
+                return flat[position]
+            index -= len(node.items)
+            node = node.rest
+            index += node.start
+        return node.items[index]
 
     # length of list
     def __len__(self):
-        counter = 0
-        current = self
-        while current != None:
-            counter += 1
-            current = current.next
-        return counter
+        return self.size
+
+# list whose elements are all python ints
+class NumberList(LinkedList):
+    __slots__ = ('packing',)
+
+    def __init__(self, items, start = 0, rest = None, packing = None):
+        super().__init__(items, start, rest)
+        # int64 numpy array of items and the largest magnitude among them,
+        # False if they cannot be packed, or None if not tried yet
+        self.packing = packing
+
+    # rest of the list, or None at the last element
+    @property
+    def next(self):
+        if self.flat is not None:
+            return NumberList(self.flat, 1) if self.size > 1 else None
+        start = self.start + 1
+        if start == len(self.items):
+            return self.rest
+        return NumberList(self.items, start, self.rest, self.packing)
+
+    # numpy array of this view's elements and the largest magnitude in
+    # the list, or None if numpy is missing or an element is too large to
+    # negate or add a few of without overflowing
+    # lists with a rest are packed whole, every time
+    def packed(self):
+        if self.rest is not None:
+            return NumberList(tuple(self)).packed()
+        if self.packing is None:
+            self.packing = False
+            bound = max(max(self.items), -min(self.items))
+            if numpy is not None and bound < 1 << 62:
+                self.packing = (numpy.array(self.items, dtype = numpy.int64), bound)
+        if not self.packing:
+            return None
+        array, bound = self.packing
+        return array[self.start:], bound
 
 ''' 
-~~~~~~~~~~~~~~~~~~~~~~~~~ EVALUATION FUNCTIONS ~~~~~~~~~~~~~~~~~~~~~~~~~
-'''     
+~~~~~~~~~~~~~~~~~~~~~~~~~ COMPILATION ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
 
-# evaluates expression
-def result_and_env(parsed, env = None):
-    if not env:
-        env = Environment()
+# each parsed expression is compiled once into a python function that
+# takes an environment and returns the expression's value, so evaluation
+# never re-inspects the parsed lists
+# compiling never modifies the parsed lists, and compiled code keeps no
+# state between runs, so a parsed program or its compiled code can be run
+# any number of times, in any environment and on any thread
+# scope describes the Frame the code will run in, or is None for code run
+# directly in an Environment
+# tail is true for expressions whose value is returned from a function
+# body, where calls to Functions return a TailCall instead of recursing
 
-    # empty expression
-    if parsed == []:
-        raise EvaluationError
-    # expression begins with value: [1 2]
-    if isinstance(parsed, list) and (isinstance(parsed[0], int) or isinstance(parsed[0], float)):
-        raise EvaluationError
-    # single value not in expression: 1
-    if isinstance(parsed, int) or isinstance(parsed, float):
-        return parsed, env
+# compile-time description of a Frame
+class Scope():
+    def __init__(self, names, parent):
+        # slot index of each name; a repeated name keeps its last slot
+        self.slots = {}
+        for slot, name in enumerate(names):
+            self.slots[name] = slot
+        self.size = len(names)
+        # scope of the enclosing Frame, or None
+        self.parent = parent
+
+    # slots of every enclosing frame that holds name, innermost first, as
+    # (depth, slot) pairs, and the number of frames before the Environment
+    def resolve(self, name):
+        addresses = []
+        depth = 0
+        scope = self
+        while scope is not None:
+            if name in scope.slots:
+                addresses.append((depth, scope.slots[name]))
+            scope = scope.parent
+            depth += 1
+        return addresses, depth
+
+# adds the names that define can bind in the frame parsed runs in to names
+# skips lambdas and lets, which run in frames of their own
+# names already in names, such as parameters, keep their slot, so a define
+# of one writes the slot the earlier reads of it use
+# folded expressions are searched as they were written, since that is
+# compiled too, to run if the builtins they relied on are redefined
+def find_defines(parsed, names):
+    if isinstance(parsed, Folded):
+        parsed = parsed.original
+    if not isinstance(parsed, list) or not parsed:
+        return
+    first_term = parsed[0]
+    if first_term == 'lambda' or first_term == 'let':
+        return
+    if first_term == 'define' and len(parsed) > 1:
+        symbol = parsed[1]
+        # easier function definition, whose body is a lambda
+        if isinstance(symbol, list):
+            if symbol and symbol[0] not in names:
+                names.append(symbol[0])
+            return
+        if symbol not in names:
+            names.append(symbol)
+        expressions = parsed[2:]
+    else:
+        expressions = parsed
+    for expression in expressions:
+        find_defines(expression, names)
+
+# whether the frames code parsed runs in can still be reached after it
+# returns, which needs a lambda made inside it to keep one as its env
+# function definitions with define make lambdas too
+def frame_escapes(parsed):
+    pending = [parsed]
+    while pending:
+        parsed = pending.pop()
+        if isinstance(parsed, Folded):
+            pending.append(parsed.original)
+            continue
+        if not isinstance(parsed, list) or not parsed:
+            continue
+        first_term = parsed[0]
+        if first_term == 'lambda' or (first_term == 'define' and len(parsed) > 1 and isinstance(parsed[1], list)):
+            return True
+        pending.extend(parsed)
+    return False
+
+# compiles the body of a function with the given parameters
+# returns the compiled body and the number of slots its frames need
+# name is what the function is reported as when profiling
+def compile_function(params, body, scope, name = 'lambda'):
+    names = list(params)
+    find_defines(body, names)
+    function_scope = Scope(names, scope)
+    code = compile_expression(body, function_scope, True)
+    profiler = compiling_profiler()
+    if profiler is not None:
+        code = profiler.wrap(('function', name), code)
+    # bodies compiled for a Budget are their own metered version
+    if getattr(compile_state, 'metered', False):
+        code.metered = code
+    return code, function_scope.size
+
+# compiled form of invalid expressions
+def run_error(env):
+    raise EvaluationError
+
+# compiles any parsed expression
+def compile_expression(parsed, scope = None, tail = False):
+    if isinstance(parsed, list):
+        # empty expression
+        if not parsed:
+            return run_error
+        first_term = parsed[0]
+        # expression begins with value: [1 2]
+        if isinstance(first_term, (int, float)):
+            return run_error
+        if isinstance(first_term, str) and first_term in special_forms:
+            try:
+                run = special_forms[first_term](parsed, scope, tail)
+            # malformed special forms only raise once they are evaluated
+            except (IndexError, TypeError):
+                return run_error
+            profiler = compiling_profiler()
+            if profiler is not None:
+                return profiler.wrap(('form', first_term), run)
+            return run
+        profiler = compiling_profiler()
+        if profiler is not None:
+            return compile_profiled_call(parsed, scope, tail, profiler)
+        if getattr(compile_state, 'metered', False):
+            return compile_metered_call(parsed, scope, tail)
+        return compile_call(parsed, scope, tail)
     # single value that is binded: val
     if isinstance(parsed, str):
-        return env[parsed], env
+        return compile_symbol(parsed, scope)
+    if isinstance(parsed, Folded):
+        return compile_folded(parsed, scope, tail)
+    # single value not in expression: 1
+    return lambda env: parsed
 
-    # operation execution
-    first_term = parsed[0]
+# returns the frame depth levels above env
+def walk_frames(env, depth):
+    for _ in range(depth):
+        env = env.parent
+    return env
 
-    # variable definition
-    if first_term == 'define':
-        # easier function definition
-        if isinstance(parsed[1], list):
-            parsed[2] = ['lambda', parsed[1][1:], parsed[2]]
-            parsed[1] = parsed[1][0]
-            return result_and_env(parsed, env)
-        symbol = parsed[1]
-        val = result_and_env(parsed[2], env)[0]
-        env[symbol] = val
-        return val, env
+# looks up name in the frames at addresses, then in the Environment depth
+# levels above env
+# used when a name's innermost slot has not been defined yet
+def lookup_slow(env, addresses, depth, name):
+    for frame_depth, slot in addresses:
+        value = walk_frames(env, frame_depth).values[slot]
+        if value is not UNBOUND:
+            return value
+    return walk_frames(env, depth)[name]
 
-    # nested function calls
-    if isinstance(first_term, list):
-        env['temp_func'] = result_and_env(first_term, env)[0]
-        first_term = 'temp_func'
+# inline cache of a global name's value, as last looked up in an
+# Environment, which stays valid until the name is defined or set! again
+# anywhere
+# entry is replaced as a whole, so threads looking up the name in different
+# Environments at once can only make each other miss
+class GlobalCache():
+    __slots__ = ('name', 'depth', 'version', 'entry')
 
-    # function definition
-    if first_term == 'lambda':
-        return Function(parsed[1], parsed[2], env), env
-
-    # if statement
-    if first_term == 'if':
-        valid = result_and_env(parsed[1], env)[0]
-        exp = parsed[2] if valid else parsed[3]
-        return result_and_env(exp, env)[0], env
-
-    # and statement 
-    # not in carlae_builtin for short circuiting
-    if first_term == 'and':
-        for expression in parsed[1:]:
-            valid = result_and_env(expression, env)[0]
+    def __init__(self, name, depth):
+        self.name = name
+        # frames between the code and the Environment
+        self.depth = depth
+        self.version = name_versions.get(name)
+        if self.version is None:
+            self.version = name_versions.setdefault(name, NameVersion())
+        # (Environment, version number, value) of the last lookup
+        self.entry = (None, None, None)
+
+    # looks name up in environment, and remembers the value found
+    def refresh(self, environment):
+        # read first, so a change during the lookup makes the entry stale
+        number = self.version.number
+        value = environment[self.name]
+        self.entry = (environment, number, value)
+        return value
+
+    def __repr__(self):
+        return repr((self.depth, self.name))
+
+# symbol lookup
+# names bound by an enclosing frame are read straight from their slot, and
+# other names are looked up in the Environment below the frames, through an
+# inline cache for code in functions, which may run many times
+def compile_symbol(name, scope):
+    if scope is None:
+        return lambda env: env[name]
+    addresses, depth = scope.resolve(name)
+    # global names
+    if not addresses:
+        cache = GlobalCache(name, depth)
+        version = cache.version
+        if depth == 1:
+            def run_global(env):
+                environment = env.parent
+                entry = cache.entry
+                if entry[0] is environment and entry[1] == version.number:
+                    return entry[2]
+                return cache.refresh(environment)
+        else:
+            def run_global(env):
+                environment = walk_frames(env, depth)
+                entry = cache.entry
+                if entry[0] is environment and entry[1] == version.number:
+                    return entry[2]
+                return cache.refresh(environment)
+        return run_global
+    frame_depth, slot = addresses[0]
+    others = addresses[1:]
+    if frame_depth == 0:
+        def run_symbol(env):
+            value = env.values[slot]
+            if value is UNBOUND:
+                return lookup_slow(env, others, depth, name)
+            return value
+    elif frame_depth == 1:
+        def run_symbol(env):
+            value = env.parent.values[slot]
+            if value is UNBOUND:
+                return lookup_slow(env, others, depth, name)
+            return value
+    else:
+        def run_symbol(env):
+            value = walk_frames(env, frame_depth).values[slot]
+            if value is UNBOUND:
+                return lookup_slow(env, others, depth, name)
+            return value
+    return run_symbol
+
+# variable definition
+def compile_define(parsed, scope, tail):
+    symbol = parsed[1]
+    # easier function definition
+    if isinstance(symbol, list):
+        return compile_define(['define', symbol[0], ['lambda', symbol[1:], parsed[2]]], scope, tail)
+    value_exp = parsed[2]
+    # defined functions are named after their symbol
+    if isinstance(value_exp, list) and value_exp and value_exp[0] == 'lambda':
+        value = compile_lambda(value_exp, scope, False, symbol)
+    else:
+        value = compile_expression(value_exp, scope)
+    if scope is None:
+        def run_define(env):
+            val = value(env)
+            env[symbol] = val
+            return val
+    else:
+        slot = scope.slots[symbol]
+        def run_define(env):
+            val = value(env)
+            env.values[slot] = val
+            return val
+    return run_define
+
+# function definition
+# anonymous functions are named after their position in the source, if known
+def compile_lambda(parsed, scope, tail, name = None):
+    # copied, so Functions never share lists with the parsed program
+    params = tuple(parsed[1])
+    body = parsed[2]
+    if name is None:
+        name = 'lambda'
+        if getattr(parsed, 'line', None) is not None:
+            name = 'lambda@%d:%d' % (parsed.line, parsed.column)
+    code, frame_size = compile_function(params, body, scope, name)
+    escapes = frame_escapes(body)
+    return lambda env: Function(params, body, env, code, frame_size, scope, escapes)
+
+# if statement
+def compile_if(parsed, scope, tail):
+    condition = compile_expression(parsed[1], scope)
+    true_exp = compile_expression(parsed[2], scope, tail)
+    # missing false branch is only an error if it is taken
+    false_exp = compile_expression(parsed[3], scope, tail) if len(parsed) > 3 else run_error
+    def run_if(env):
+        if condition(env):
+            return true_exp(env)
+        return false_exp(env)
+    return run_if
+
+# and statement 
+# not in carlae_builtin for short circuiting
+def compile_and(parsed, scope, tail):
+    expressions = [compile_expression(expression, scope) for expression in parsed[1:]]
+    def run_and(env):
+        for expression in expressions:
             # short circuit check
-            if not valid:
-                return False, env
-        return True, env
-
-    # or statement
-    # not in carlae_builtin for short circuiting
-    if first_term == 'or':
-        for expression in parsed[1:]:
-            valid = result_and_env(expression, env)[0]
+            if not expression(env):
+                return False
+        return True
+    return run_and
+
+# or statement
+# not in carlae_builtin for short circuiting
+def compile_or(parsed, scope, tail):
+    expressions = [compile_expression(expression, scope) for expression in parsed[1:]]
+    def run_or(env):
+        for expression in expressions:
             # short circuit check
-            if valid:
-                return True, env
-        return False, env
+            if expression(env):
+                return True
+        return False
+    return run_or
 
-    # begin expression
-    if first_term == 'begin':
-        for expression in parsed[1:]:
-            last_val = evaluate(expression, env)
-        return last_val, env
+# begin expression
+def compile_begin(parsed, scope, tail):
+    if len(parsed) == 1:
+        return run_error
+    expressions = [compile_expression(expression, scope) for expression in parsed[1:-1]]
+    last = compile_expression(parsed[-1], scope, tail)
+    def run_begin(env):
+        for expression in expressions:
+            expression(env)
+        return last(env)
+    return run_begin
 
-    # let expression
-    if first_term == 'let':
-        # list of vars and values
-        bounded = parsed[1]
-        # body to be evaluated and returned
-        body = parsed[2]
+# let expression
+# runs in a new frame holding the bound vars and anything defined inside
+def compile_let(parsed, scope, tail):
+    names = []
+    for var in parsed[1]:
+        names.append(var[0])
+        find_defines(var[1], names)
+    find_defines(parsed[2], names)
+    let_scope = Scope(names, scope)
+    size = let_scope.size
+    # slots of vars and compiled values
+    bounded = [(let_scope.slots[var[0]], compile_expression(var[1], let_scope)) for var in parsed[1]]
+    # body to be evaluated and returned
+    body = compile_expression(parsed[2], let_scope, tail)
+    def run_let(env):
         # creating subenvironment
-        sub_env = Environment(env)
-        for var in bounded:
+        frame = Frame([UNBOUND] * size, env)
+        values = frame.values
+        for slot, value in bounded:
             # updating values in subenvironment
-            sub_env[var[0]] = result_and_env(var[1], sub_env)[0]
-        return result_and_env(body, sub_env)[0], env
-
-    # set! expression
-    if first_term == 'set!':
-        var_name = parsed[1]
-        new_val = result_and_env(parsed[2], env)[0]
-        cur_env = env
-        # checking all parent envs until no more or in current env
-        while cur_env != carlae_builtins and var_name not in cur_env.symbols:
-            cur_env = cur_env.parent
-        # raise error if not in cur_env
-        if cur_env == carlae_builtins:
+            values[slot] = value(frame)
+        return body(frame)
+    return run_let
+
+# assigns new_val to the innermost defined binding of var_name, looking in
+# the frames at addresses, then in the Environment depth levels above env
+def set_variable(env, addresses, depth, var_name, new_val):
+    for frame_depth, slot in addresses:
+        values = walk_frames(env, frame_depth).values
+        if values[slot] is not UNBOUND:
+            values[slot] = new_val
+            return new_val
+    cur_env = walk_frames(env, depth)
+    # checking all parent envs until no more or in current env
+    while cur_env is not carlae_builtins and var_name not in cur_env.symbols:
+        cur_env = cur_env.parent
+    # raise error if not in cur_env
+    if cur_env is carlae_builtins:
+        raise EvaluationError
+    # set value in cur_env
+    cur_env[var_name] = new_val
+    return new_val
+
+# set! expression
+# assigns the innermost defined binding of the name
+def compile_set(parsed, scope, tail):
+    var_name = parsed[1]
+    value = compile_expression(parsed[2], scope)
+    if scope is None:
+        addresses, depth = [], 0
+    else:
+        addresses, depth = scope.resolve(var_name)
+    def run_set(env):
+        return set_variable(env, addresses, depth, var_name, value(env))
+    return run_set
+
+# function call, including nested function calls: ((f 1) 2)
+# the operator is evaluated before the operands
+# the common small operand counts get their own closures to avoid
+# looping over the operands, and calls with one or two operands use the
+# one- or two-argument version of builtins that have one
+def compile_call(parsed, scope, tail):
+    get_operation = compile_expression(parsed[0], scope)
+    operands = [compile_expression(expression, scope) for expression in parsed[1:]]
+    if len(operands) == 0:
+        def run_call(env):
+            operation = get_operation(env)
+            if tail and type(operation) is Function:
+                return TailCall(operation, [])
+            return operation([])
+    elif len(operands) == 1:
+        first, = operands
+        def run_call(env):
+            operation = get_operation(env)
+            first_val = first(env)
+            unary = unary_builtins.get(operation)
+            if unary is not None:
+                return unary(first_val)
+            params = [first_val]
+            if tail and type(operation) is Function:
+                return TailCall(operation, params)
+            return operation(params)
+    elif len(operands) == 2:
+        first, second = operands
+        def run_call(env):
+            operation = get_operation(env)
+            first_val = first(env)
+            second_val = second(env)
+            binary = binary_builtins.get(operation)
+            if binary is not None:
+                return binary(first_val, second_val)
+            params = [first_val, second_val]
+            if tail and type(operation) is Function:
+                return TailCall(operation, params)
+            return operation(params)
+    elif len(operands) == 3:
+        first, second, third = operands
+        def run_call(env):
+            operation = get_operation(env)
+            params = [first(env), second(env), third(env)]
+            if tail and type(operation) is Function:
+                return TailCall(operation, params)
+            return operation(params)
+    else:
+        def run_call(env):
+            operation = get_operation(env)
+            params = [operand(env) for operand in operands]
+            if tail and type(operation) is Function:
+                return TailCall(operation, params)
+            return operation(params)
+    return run_call
+
+# function call compiled for profiling
+# calls to builtins are recorded here, while Functions record themselves
+# from their compiled body, which also covers tail calls
+def compile_profiled_call(parsed, scope, tail, profiler):
+    get_operation = compile_expression(parsed[0], scope)
+    operands = [compile_expression(expression, scope) for expression in parsed[1:]]
+    def run_call(env):
+        operation = get_operation(env)
+        params = [operand(env) for operand in operands]
+        if type(operation) is Function:
+            if tail:
+                return TailCall(operation, params)
+            return operation(params)
+        name = profiler.builtin_names.get(operation)
+        if name is None:
+            return operation(params)
+        profiler.enter(('builtin', name))
+        try:
+            return operation(params)
+        finally:
+            profiler.exit()
+    return run_call
+
+# compilers for expressions that are not function calls
+special_forms = {
+    'define': compile_define,
+    'lambda': compile_lambda,
+    'if': compile_if,
+    'and': compile_and,
+    'or': compile_or,
+    'begin': compile_begin,
+    'let': compile_let,
+    'set!': compile_set,
+}
+
+''' 
+~~~~~~~~~~~~~~~~~~~~~~~~~ CONSTANT FOLDING ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# pass over parsed expressions, run before they are compiled, that works
+# out calls of builtins on constants, drops the branches of if, and and or
+# that constants rule out, and puts constants bound by let where they are
+# used
+# results that rely on builtin names (including #t and #f) are Folded
+# nodes, which run their original expression instead once any of those
+# names has been defined in an Environment, so folding is never visible
+# to programs that shadow builtins, whenever they do it
+# names bound by frames are known from the program, and are never folded
+
+# builtins whose calls on constants give the same value whenever they run
+FOLDABLE_BUILTINS = {'+', '-', '*', '/', '=?', '>', '>=', '<', '<=', 'not'}
+
+# builtin names that have been defined in any Environment
+# version changes every time names does
+class BuiltinShadows():
+    def __init__(self):
+        self.names = frozenset()
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def add(self, name):
+        with self.lock:
+            if name not in self.names:
+                # replaced rather than changed, as other threads may be
+                # reading it
+                self.names = self.names | {name}
+                self.version += 1
+
+builtin_shadows = BuiltinShadows()
+
+# expression computed from original without running it, which relied on
+# the builtin names in names not being shadowed as of version
+class Folded():
+    __slots__ = ('expression', 'original', 'names', 'version')
+
+    def __init__(self, expression, original, names, version):
+        self.expression = expression
+        self.original = original
+        self.names = names
+        self.version = version
+
+# checks that the names a Folded expression relied on are still builtins
+class FoldGuard():
+    __slots__ = ('names', 'version', 'fallback')
+
+    def __init__(self, folded):
+        self.names = folded.names
+        self.version = folded.version
+        # index of the original expression's bytecode, for the VM
+        self.fallback = None
+
+    def holds(self):
+        version = builtin_shadows.version
+        if self.version != version:
+            if not self.names.isdisjoint(builtin_shadows.names):
+                return False
+            self.version = version
+        return True
+
+# raised when constants cannot be put in place of the names binding them
+class CannotInline(Exception):
+    pass
+
+# expression as a Folded node relying on names, or left as it is if it
+# relies on nothing
+def fold(expression, original, names, version):
+    if not names:
+        return expression
+    if isinstance(expression, Folded):
+        names = names | expression.names
+        expression = expression.expression
+    return Folded(expression, original, frozenset(names), version)
+
+# (value, names relied on) of a constant expression, or None
+def constant_value(parsed):
+    if isinstance(parsed, Folded):
+        parsed, names = parsed.expression, parsed.names
+    else:
+        names = frozenset()
+    if isinstance(parsed, (int, float)):
+        return parsed, names
+    return None
+
+# whether name is still the builtin where it is used, in a frame
+# described by scope
+def builtin_name(name, scope):
+    if not isinstance(name, str) or name not in carlae_builtins or name in builtin_shadows.names:
+        return False
+    return scope is None or not scope.resolve(name)[0]
+
+# optimized copy of a top-level expression
+# parsed itself is never modified, and parts left as they were are shared
+def fold_constants(parsed):
+    return fold_expression(parsed, None, builtin_shadows.version)
+
+# optimizes parsed, which runs in a frame described by scope
+def fold_expression(parsed, scope, version):
+    if not isinstance(parsed, list):
+        if (parsed == '#t' or parsed == '#f') and builtin_name(parsed, scope):
+            return Folded(carlae_builtins[parsed], parsed, frozenset([parsed]), version)
+        return parsed
+    if not parsed:
+        return parsed
+    first_term = parsed[0]
+    if isinstance(first_term, str) and first_term in special_forms:
+        if first_term not in fold_forms:
+            return parsed
+        try:
+            return fold_forms[first_term](parsed, scope, version)
+        # malformed special forms are left for the compiler to report
+        except (IndexError, TypeError):
+            return parsed
+    terms = [fold_expression(term, scope, version) for term in parsed]
+    if isinstance(first_term, str) and first_term in FOLDABLE_BUILTINS and builtin_name(first_term, scope):
+        constants = [constant_value(term) for term in terms[1:]]
+        if None not in constants:
+            try:
+                value = carlae_builtins[first_term]([constant[0] for constant in constants])
+            # calls that raise do so when they run
+            except Exception:
+                value = None
+            if type(value) in (int, float, bool):
+                names = frozenset([first_term]).union(*(constant[1] for constant in constants))
+                return Folded(value, parsed, names, version)
+    return rebuilt(parsed, terms)
+
+# parsed if terms are the same as its own, else terms in its place
+def rebuilt(parsed, terms):
+    if len(terms) == len(parsed) and all(map(operator.is_, terms, parsed)):
+        return parsed
+    return positioned(parsed, terms)
+
+# terms, remembering where parsed began in the source if it knows, so
+# lambdas are still named after their position
+def positioned(parsed, terms):
+    line = getattr(parsed, 'line', None)
+    if line is None:
+        return terms
+    expression = Expression(terms)
+    expression.line = line
+    expression.column = parsed.column
+    return expression
+
+# scope of the frames of a function with params and body
+def function_scope(params, body, scope):
+    names = list(params)
+    find_defines(body, names)
+    return Scope(names, scope)
+
+def fold_define(parsed, scope, version):
+    symbol = parsed[1]
+    # easier function definition, whose body runs in a frame of its own
+    if isinstance(symbol, list):
+        body_scope = function_scope(symbol[1:], parsed[2], scope)
+        return rebuilt(parsed, parsed[:2] + [fold_expression(parsed[2], body_scope, version)])
+    return rebuilt(parsed, parsed[:2] + [fold_expression(parsed[2], scope, version)])
+
+def fold_lambda(parsed, scope, version):
+    body_scope = function_scope(parsed[1], parsed[2], scope)
+    return rebuilt(parsed, parsed[:2] + [fold_expression(parsed[2], body_scope, version)])
+
+def fold_if(parsed, scope, version):
+    terms = [parsed[0]] + [fold_expression(term, scope, version) for term in parsed[1:]]
+    condition = constant_value(terms[1])
+    # a missing false branch is only an error if it is taken
+    if condition is None or (not condition[0] and len(terms) < 4):
+        return rebuilt(parsed, terms)
+    return fold(terms[2] if condition[0] else terms[3], parsed, condition[1], version)
+
+# and and or drop the constants that do not decide their value, and stop
+# at the first one that does
+def fold_and(parsed, scope, version):
+    return fold_short_circuit(parsed, scope, version, False)
+
+def fold_or(parsed, scope, version):
+    return fold_short_circuit(parsed, scope, version, True)
+
+def fold_short_circuit(parsed, scope, version, deciding):
+    terms = [parsed[0]]
+    names = frozenset()
+    for expression in parsed[1:]:
+        term = fold_expression(expression, scope, version)
+        constant = constant_value(term)
+        if constant is None:
+            terms.append(term)
+            continue
+        names = names | constant[1]
+        if bool(constant[0]) == deciding:
+            # the expressions before it still run
+            if len(terms) == 1:
+                return fold(deciding, parsed, names, version)
+            terms.append(deciding)
+            break
+    if len(terms) == 1:
+        return fold(not deciding, parsed, names, version)
+    if not names:
+        return rebuilt(parsed, terms)
+    return fold(terms, parsed, names, version)
+
+def fold_begin(parsed, scope, version):
+    return rebuilt(parsed, [parsed[0]] + [fold_expression(term, scope, version) for term in parsed[1:]])
+
+def fold_set(parsed, scope, version):
+    return rebuilt(parsed, parsed[:2] + [fold_expression(parsed[2], scope, version)])
+
+# vars bound to constants are replaced by them in the body, unless they
+# are used by the vars' values, called, assigned or bound again inside it
+# a let left with no vars and nothing defined in it becomes its body
+def fold_let(parsed, scope, version):
+    bindings, body = parsed[1], parsed[2]
+    names = []
+    for var in bindings:
+        names.append(var[0])
+        find_defines(var[1], names)
+    find_defines(body, names)
+    let_scope = Scope(names, scope)
+    values = [fold_expression(var[1], let_scope, version) for var in bindings]
+    constants = {}
+    # names that must mean the same wherever the constants are put
+    protected = set()
+    # names the values use, which must still be bound by the let
+    used = set()
+    for var, value in zip(bindings, values):
+        symbols = set()
+        add_symbols(var[1], symbols)
+        used.update(symbols)
+        constant = constant_value(value)
+        # folded values run their original expression, in the body, once
+        # the builtins they relied on are shadowed, so it may use nothing else
+        if constant is None or symbols.difference(special_forms, constant[1]):
+            continue
+        if names.count(var[0]) == 1 and var[0] not in special_forms:
+            constants[var[0]] = value
+            protected.update(constant[1])
+    for name in used.intersection(constants):
+        del constants[name]
+    if constants:
+        protected.update(constants)
+        try:
+            body = substitute(body, constants, protected)
+        except CannotInline:
+            constants = {}
+            body = parsed[2]
+    body = fold_expression(body, let_scope, version)
+    if not constants:
+        new_bindings = rebuilt(bindings, [rebuilt(var, [var[0], value] + var[2:]) for var, value in zip(bindings, values)])
+        return rebuilt(parsed, [parsed[0], new_bindings, body] + parsed[3:])
+    kept = [[var[0], value] + var[2:] for var, value in zip(bindings, values) if var[0] not in constants]
+    if not kept and len(names) == len(bindings):
+        return body
+    return positioned(parsed, [parsed[0], kept, body] + parsed[3:])
+
+# copy of parsed with the names in constants replaced by their values
+# raises CannotInline where a name in protected is bound or assigned, or
+# a name in constants is called
+def substitute(parsed, constants, protected):
+    if isinstance(parsed, str):
+        return constants.get(parsed, parsed)
+    if not isinstance(parsed, list) or not parsed:
+        return parsed
+    first_term = parsed[0]
+    if isinstance(first_term, str) and first_term in constants:
+        raise CannotInline
+    # names bound or assigned by special forms
+    if first_term == 'lambda':
+        names, start = parsed[1], 2
+    elif first_term == 'define':
+        names, start = (parsed[1] if isinstance(parsed[1], list) else [parsed[1]]), 2
+    elif first_term == 'set!':
+        names, start = [parsed[1]], 2
+    elif first_term == 'let':
+        names, start = [var[0] for var in parsed[1]], 2
+    else:
+        names, start = [], 0
+    for name in names:
+        if isinstance(name, str) and name in protected:
+            raise CannotInline
+    if first_term == 'let':
+        bindings = [[var[0]] + [substitute(term, constants, protected) for term in var[1:]] for var in parsed[1]]
+        return positioned(parsed, [first_term, bindings] + [substitute(term, constants, protected) for term in parsed[2:]])
+    return positioned(parsed, parsed[:start] + [substitute(term, constants, protected) for term in parsed[start:]])
+
+# optimizers for special forms
+fold_forms = {
+    'define': fold_define,
+    'lambda': fold_lambda,
+    'if': fold_if,
+    'and': fold_and,
+    'or': fold_or,
+    'begin': fold_begin,
+    'let': fold_let,
+    'set!': fold_set,
+}
+
+# runs the folded expression while the names it relied on are builtins,
+# and the original after that
+def compile_folded(folded, scope, tail):
+    original = compile_expression(folded.original, scope, tail)
+    guard = FoldGuard(folded)
+    if isinstance(folded.expression, (int, float)):
+        value = folded.expression
+        def run_folded(env):
+            if guard.version == builtin_shadows.version or guard.holds():
+                return value
+            return original(env)
+        return run_folded
+    optimized = compile_expression(folded.expression, scope, tail)
+    def run_folded(env):
+        if guard.version == builtin_shadows.version or guard.holds():
+            return optimized(env)
+        return original(env)
+    return run_folded
+
+''' 
+~~~~~~~~~~~~~~~~~~~~~~~~~ BYTECODE VM ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# second backend, selected with vm = True in the evaluation functions
+# parsed expressions are compiled to a flat list of ints, read as
+# (opcode, argument) pairs, plus a pool of constants the arguments index
+# into, and run by a loop with its own stack of calls, so calls between
+# compiled functions do not use the python stack
+# names are resolved with the same Scopes and stored in the same Frames and
+# Environments as the closure compiler, so values and environments can be
+# shared between the two
+
+# opcodes
+# values are pushed on and popped from a stack shared by all calls
+CONST = 0         # push constants[arg]
+LOCAL = 1         # push slot arg of the current frame
+OUTER = 2         # push the slot at (depth, slot, others, env depth, name) = constants[arg]
+GLOBAL = 3        # push a global name through GlobalCache constants[arg]
+NAME = 4          # push name constants[arg] of the current Environment
+CALL = 5          # call the function below the top arg values with them
+TAIL_CALL = 6     # call as CALL, replacing the current call if it is to a VMFunction
+RETURN = 7        # return the top value to the caller
+JUMP = 8          # continue at index arg of the code
+JUMP_IF_FALSE = 9 # pop a value and jump to arg if it is false
+JUMP_IF_TRUE = 10 # pop a value and jump to arg if it is true
+POP = 11          # drop the top value
+DEFINE_LOCAL = 12 # store the top value in slot arg of the current frame
+DEFINE_NAME = 13  # define name constants[arg] as the top value in the current Environment
+STORE = 14        # pop a value into slot arg of the current frame
+SET = 15          # set! with (addresses, depth, name) = constants[arg], keeping the value
+CLOSURE = 16      # push a VMFunction made from (params, body, code, frame size, scope) = constants[arg]
+LET = 17          # enter a new frame of arg slots
+END_LET = 18      # leave the frame entered by LET
+ERROR = 19        # raise EvaluationError
+GUARD = 20        # jump to the fallback of FoldGuard constants[arg] unless it holds
+
+OPCODE_NAMES = ['CONST', 'LOCAL', 'OUTER', 'GLOBAL', 'NAME', 'CALL', 'TAIL_CALL', 'RETURN',
+                'JUMP', 'JUMP_IF_FALSE', 'JUMP_IF_TRUE', 'POP', 'DEFINE_LOCAL', 'DEFINE_NAME',
+                'STORE', 'SET', 'CLOSURE', 'LET', 'END_LET', 'ERROR', 'GUARD']
+
+# compiled code of a top-level expression or function body
+class Bytecode():
+    __slots__ = ('code', 'constants', 'lookups')
+
+    def __init__(self):
+        # opcode and argument of each instruction, one after the other
+        self.code = []
+        self.constants = []
+        # other addresses, Environment depth and name of the symbol read by
+        # the LOCAL instruction at each index, for when its slot is unbound
+        self.lookups = {}
+
+    # appends an instruction and returns its index
+    def emit(self, opcode, arg = 0):
+        self.code.append(opcode)
+        self.code.append(arg)
+        return len(self.code) - 2
+
+    # adds a value to the constant pool and returns its index
+    def constant(self, value):
+        self.constants.append(value)
+        return len(self.constants) - 1
+
+    # sets the argument of the jump at index to the end of the code
+    def patch(self, index):
+        self.code[index + 1] = len(self.code)
+
+# readable listing of code, one instruction per line
+def disassemble(bytecode):
+    code = bytecode.code
+    lines = []
+    for index in range(0, len(code), 2):
+        opcode, arg = code[index], code[index + 1]
+        line = '%4d %-14s %d' % (index, OPCODE_NAMES[opcode], arg)
+        if opcode in (CONST, OUTER, GLOBAL, NAME, DEFINE_NAME, SET):
+            line += ' (%r)' % (bytecode.constants[arg],)
+        lines.append(line)
+    return '\n'.join(lines)
+
+# function made by the bytecode compiler
+class VMFunction():
+    __slots__ = ('params', 'function', 'env', 'scope', 'code', 'padding')
+
+    def __init__(self, params, function, env, code, frame_size, scope = None):
+        # sequence of parameters for function
+        self.params = params
+        # parsed body of function
+        self.function = function
+        # env where function was defined
+        self.env = env
+        # Scope describing env, or None if env is an Environment
+        self.scope = scope
+        # compiled body
+        self.code = code
+        # slots after the parameters, for names defined in the body
+        self.padding = [UNBOUND] * (frame_size - len(params))
+
+    # calls from python, such as from map, run a VM loop of their own
+    def __call__(self, params):
+        if len(self.params) != len(params):
             raise EvaluationError
-        # set value in cur_env
-        else:
-            cur_env[var_name] = new_val
-            return new_val, env
+        if self.padding:
+            params = params + self.padding
+        budget = limit_state.budget
+        if budget is not None:
+            budget.step()
+        return run_bytecode(self.code, Frame(params, self.env), budget)
 
+# compiles parsed into bytecode, which is left with its value on the stack
+# in tail position of a function body, calls become TAIL_CALLs
+def emit_expression(parsed, scope, tail, bytecode):
+    if isinstance(parsed, list):
+        # empty expression, or expression beginning with value: [1 2]
+        if not parsed or isinstance(parsed[0], (int, float)):
+            bytecode.emit(ERROR)
+            return
+        first_term = parsed[0]
+        if isinstance(first_term, str) and first_term in vm_special_forms:
+            start = len(bytecode.code)
+            try:
+                vm_special_forms[first_term](parsed, scope, tail, bytecode)
+            # malformed special forms only raise once they are evaluated
+            except (IndexError, TypeError):
+                del bytecode.code[start:]
+                bytecode.emit(ERROR)
+            return
+        emit_call(parsed, scope, tail, bytecode)
+    # single value that is binded: val
+    elif isinstance(parsed, str):
+        emit_symbol(parsed, scope, bytecode)
+    elif isinstance(parsed, Folded):
+        emit_folded(parsed, scope, tail, bytecode)
+    # single value not in expression: 1
+    else:
+        bytecode.emit(CONST, bytecode.constant(parsed))
+
+def emit_symbol(name, scope, bytecode):
+    if scope is None:
+        bytecode.emit(NAME, bytecode.constant(name))
+        return
+    addresses, depth = scope.resolve(name)
+    # global names
+    if not addresses:
+        bytecode.emit(GLOBAL, bytecode.constant(GlobalCache(name, depth)))
+        return
+    frame_depth, slot = addresses[0]
+    others = addresses[1:]
+    if frame_depth == 0:
+        index = bytecode.emit(LOCAL, slot)
+        bytecode.lookups[index] = (others, depth, name)
+    else:
+        bytecode.emit(OUTER, bytecode.constant((frame_depth, slot, others, depth, name)))
+
+# compiles a function body into bytecode of its own
+def emit_function(params, body, scope):
+    names = list(params)
+    find_defines(body, names)
+    function_scope = Scope(names, scope)
+    bytecode = Bytecode()
+    emit_expression(body, function_scope, True, bytecode)
+    bytecode.emit(RETURN)
+    return bytecode, function_scope.size
+
+def emit_define(parsed, scope, tail, bytecode):
+    symbol = parsed[1]
+    # easier function definition
+    if isinstance(symbol, list):
+        emit_define(['define', symbol[0], ['lambda', symbol[1:], parsed[2]]], scope, tail, bytecode)
+        return
+    emit_expression(parsed[2], scope, False, bytecode)
+    if scope is None:
+        bytecode.emit(DEFINE_NAME, bytecode.constant(symbol))
+    else:
+        bytecode.emit(DEFINE_LOCAL, scope.slots[symbol])
+
+def emit_lambda(parsed, scope, tail, bytecode):
+    # copied, so VMFunctions never share lists with the parsed program
+    params = tuple(parsed[1])
+    body = parsed[2]
+    code, frame_size = emit_function(params, body, scope)
+    bytecode.emit(CLOSURE, bytecode.constant((params, body, code, frame_size, scope)))
+
+def emit_if(parsed, scope, tail, bytecode):
+    emit_expression(parsed[1], scope, False, bytecode)
+    false_jump = bytecode.emit(JUMP_IF_FALSE)
+    emit_expression(parsed[2], scope, tail, bytecode)
+    end_jump = bytecode.emit(JUMP)
+    bytecode.patch(false_jump)
+    # missing false branch is only an error if it is taken
+    if len(parsed) > 3:
+        emit_expression(parsed[3], scope, tail, bytecode)
+    else:
+        bytecode.emit(ERROR)
+    bytecode.patch(end_jump)
+
+# and and or push True or False, jumping out at the first value that
+# decides the result
+def emit_and(parsed, scope, tail, bytecode):
+    emit_short_circuit(parsed, scope, bytecode, JUMP_IF_FALSE, True)
 
-    # simple operator in carlae_builtins
-    operands = []
-    operation = env[first_term]
+def emit_or(parsed, scope, tail, bytecode):
+    emit_short_circuit(parsed, scope, bytecode, JUMP_IF_TRUE, False)
+
+def emit_short_circuit(parsed, scope, bytecode, jump, finished):
+    jumps = []
     for expression in parsed[1:]:
-        operands.append(result_and_env(expression, env)[0])
-    # performing operation on operands
-    return operation(operands), env
+        emit_expression(expression, scope, False, bytecode)
+        jumps.append(bytecode.emit(jump))
+    bytecode.emit(CONST, bytecode.constant(finished))
+    end_jump = bytecode.emit(JUMP)
+    for index in jumps:
+        bytecode.patch(index)
+    bytecode.emit(CONST, bytecode.constant(not finished))
+    bytecode.patch(end_jump)
+
+def emit_begin(parsed, scope, tail, bytecode):
+    if len(parsed) == 1:
+        bytecode.emit(ERROR)
+        return
+    for expression in parsed[1:-1]:
+        emit_expression(expression, scope, False, bytecode)
+        bytecode.emit(POP)
+    emit_expression(parsed[-1], scope, tail, bytecode)
+
+def emit_let(parsed, scope, tail, bytecode):
+    names = []
+    for var in parsed[1]:
+        names.append(var[0])
+        find_defines(var[1], names)
+    find_defines(parsed[2], names)
+    let_scope = Scope(names, scope)
+    bytecode.emit(LET, let_scope.size)
+    for var in parsed[1]:
+        emit_expression(var[1], let_scope, False, bytecode)
+        bytecode.emit(STORE, let_scope.slots[var[0]])
+    emit_expression(parsed[2], let_scope, tail, bytecode)
+    bytecode.emit(END_LET)
+
+def emit_set(parsed, scope, tail, bytecode):
+    var_name = parsed[1]
+    emit_expression(parsed[2], scope, False, bytecode)
+    if scope is None:
+        addresses, depth = [], 0
+    else:
+        addresses, depth = scope.resolve(var_name)
+    bytecode.emit(SET, bytecode.constant((addresses, depth, var_name)))
+
+# the folded expression, then the original one, which GUARD jumps to once
+# the names the folding relied on are shadowed
+def emit_folded(folded, scope, tail, bytecode):
+    guard = FoldGuard(folded)
+    bytecode.emit(GUARD, bytecode.constant(guard))
+    emit_expression(folded.expression, scope, tail, bytecode)
+    end_jump = bytecode.emit(JUMP)
+    guard.fallback = len(bytecode.code)
+    emit_expression(folded.original, scope, tail, bytecode)
+    bytecode.patch(end_jump)
+
+# pushes the operator and then the operands, in evaluation order
+def emit_call(parsed, scope, tail, bytecode):
+    for expression in parsed:
+        emit_expression(expression, scope, False, bytecode)
+    bytecode.emit(TAIL_CALL if tail else CALL, len(parsed) - 1)
+
+# compilers for expressions that are not function calls
+vm_special_forms = {
+    'define': emit_define,
+    'lambda': emit_lambda,
+    'if': emit_if,
+    'and': emit_and,
+    'or': emit_or,
+    'begin': emit_begin,
+    'let': emit_let,
+    'set!': emit_set,
+}
+
+# compiles a top-level expression
+def compile_bytecode(parsed):
+    bytecode = Bytecode()
+    emit_expression(parsed, None, False, bytecode)
+    bytecode.emit(RETURN)
+    return bytecode
+
+# most calls the VM keeps waiting for a value at once
+# the VM does not use the python stack for calls, so it stops runaway
+# recursion here, with the RecursionError the closure compiler would raise
+VM_MAX_CALLS = 100000
+
+# runs bytecode in env until it returns from its outermost call
+# with a Budget, every call is charged to it
+def run_bytecode(bytecode, env, budget = None):
+    code = bytecode.code
+    constants = bytecode.constants
+    pc = 0
+    stack = []
+    # (bytecode, pc, env) of each call waiting for a value
+    calls = []
+    while True:
+        opcode = code[pc]
+        arg = code[pc + 1]
+        pc += 2
+        if opcode == LOCAL:
+            value = env.values[arg]
+            if value is UNBOUND:
+                others, depth, name = bytecode.lookups[pc - 2]
+                value = lookup_slow(env, others, depth, name)
+            stack.append(value)
+        elif opcode == CONST:
+            stack.append(constants[arg])
+        elif opcode == CALL or opcode == TAIL_CALL:
+            # builtins with a one- or two-argument version take their
+            # operands straight off the stack
+            if arg == 2 and budget is None:
+                binary = binary_builtins.get(stack[-3])
+                if binary is not None:
+                    second = stack.pop()
+                    first = stack.pop()
+                    stack[-1] = binary(first, second)
+                    continue
+            elif arg == 1 and budget is None:
+                unary = unary_builtins.get(stack[-2])
+                if unary is not None:
+                    operand = stack.pop()
+                    stack[-1] = unary(operand)
+                    continue
+            if arg:
+                params = stack[-arg:]
+                del stack[-arg:]
+            else:
+                params = []
+            function = stack.pop()
+            if budget is not None:
+                # Functions of the closure compiler charge their own calls
+                if type(function) is not Function:
+                    budget.step()
+                if type(function) is not VMFunction:
+                    # calls waiting in this loop count towards the depth of
+                    # functions run by builtins
+                    budget.depth += len(calls)
+                    try:
+                        stack.append(budget.call(function, params))
+                    finally:
+                        budget.depth -= len(calls)
+                    continue
+                if opcode == CALL and budget.depth + len(calls) >= budget.max_depth:
+                    raise ResourceLimitExceeded('depth')
+            if type(function) is VMFunction:
+                if len(function.params) != arg:
+                    raise EvaluationError
+                if function.padding:
+                    params = params + function.padding
+                if opcode == CALL:
+                    if len(calls) >= VM_MAX_CALLS:
+                        raise RecursionError
+                    calls.append((bytecode, pc, env))
+                bytecode = function.code
+                code = bytecode.code
+                constants = bytecode.constants
+                pc = 0
+                env = Frame(params, function.env)
+            else:
+                stack.append(function(params))
+        elif opcode == JUMP_IF_FALSE:
+            if not stack.pop():
+                pc = arg
+        elif opcode == RETURN:
+            if not calls:
+                return stack.pop()
+            bytecode, pc, env = calls.pop()
+            code = bytecode.code
+            constants = bytecode.constants
+        elif opcode == GLOBAL:
+            cache = constants[arg]
+            environment = walk_frames(env, cache.depth)
+            entry = cache.entry
+            if entry[0] is environment and entry[1] == cache.version.number:
+                stack.append(entry[2])
+            else:
+                stack.append(cache.refresh(environment))
+        elif opcode == OUTER:
+            frame_depth, slot, others, depth, name = constants[arg]
+            value = walk_frames(env, frame_depth).values[slot]
+            if value is UNBOUND:
+                value = lookup_slow(env, others, depth, name)
+            stack.append(value)
+        elif opcode == JUMP:
+            pc = arg
+        elif opcode == NAME:
+            stack.append(env[constants[arg]])
+        elif opcode == JUMP_IF_TRUE:
+            if stack.pop():
+                pc = arg
+        elif opcode == POP:
+            stack.pop()
+        elif opcode == DEFINE_LOCAL:
+            env.values[arg] = stack[-1]
+        elif opcode == STORE:
+            env.values[arg] = stack.pop()
+        elif opcode == CLOSURE:
+            params, body, function_code, frame_size, scope = constants[arg]
+            stack.append(VMFunction(params, body, env, function_code, frame_size, scope))
+        elif opcode == LET:
+            env = Frame([UNBOUND] * arg, env)
+        elif opcode == END_LET:
+            env = env.parent
+        elif opcode == DEFINE_NAME:
+            env[constants[arg]] = stack[-1]
+        elif opcode == SET:
+            addresses, depth, var_name = constants[arg]
+            set_variable(env, addresses, depth, var_name, stack[-1])
+        elif opcode == GUARD:
+            guard = constants[arg]
+            if guard.version != builtin_shadows.version and not guard.holds():
+                pc = guard.fallback
+        else:
+            raise EvaluationError
+
+''' 
+~~~~~~~~~~~~~~~~~~~~~~~~~ PROFILING ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# code compiled while a profiler is set reports every function call,
+# builtin call and special form it runs to that profiler
+# profiling is decided when code is compiled, so code compiled without a
+# profiler runs exactly as it would if profiling did not exist
+
+# profiler that code being compiled on this thread reports to
+compile_state = threading.local()
+
+def compiling_profiler():
+    return getattr(compile_state, 'profiler', None)
+
+# call counts and times of everything run by code compiled for it
+# entries are keyed by (kind, name), where kind is 'function', 'builtin'
+# or 'form'
+class Profiler():
+    def __init__(self, clock = time.perf_counter):
+        self.clock = clock
+        # [calls, cumulative time, self time] of each entry
+        # cumulative time counts recursive calls of an entry once
+        self.stats = {}
+        # [key, start time, time spent in children, call tree node] of
+        # each entry currently running
+        self.stack = []
+        # number of times each entry is on the stack
+        self.active = {}
+        # root of the call tree, whose nodes are [self time, children by key]
+        self.tree = [0, {}]
+        # name of each builtin, by value
+        self.builtin_names = {value: name for name, value in carlae_builtins.items() if callable(value)}
+
+    # compiled code that runs run as the entry key
+    def wrap(self, key, run):
+        enter = self.enter
+        exit = self.exit
+        def run_profiled(env):
+            enter(key)
+            try:
+                return run(env)
+            finally:
+                exit()
+        return run_profiled
+
+    def enter(self, key):
+        stack = self.stack
+        parent = stack[-1][3] if stack else self.tree
+        node = parent[1].get(key)
+        if node is None:
+            node = parent[1][key] = [0, {}]
+        self.active[key] = self.active.get(key, 0) + 1
+        stack.append([key, self.clock(), 0, node])
+
+    def exit(self):
+        key, start, children, node = self.stack.pop()
+        elapsed = self.clock() - start
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = [0, 0, 0]
+        stats[0] += 1
+        stats[2] += elapsed - children
+        node[0] += elapsed - children
+        self.active[key] -= 1
+        if not self.active[key]:
+            stats[1] += elapsed
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    # table of entries, with the most self time first
+    def report(self, limit = None):
+        rows = sorted(self.stats.items(), key = lambda item: item[1][2], reverse = True)
+        lines = ['%10s %12s %12s  %-8s %s' % ('calls', 'cumulative', 'self', 'kind', 'name')]
+        for (kind, name), (calls, cumulative, self_time) in rows[:limit]:
+            lines.append('%10d %12.6f %12.6f  %-8s %s' % (calls, cumulative, self_time, kind, name))
+        return '\n'.join(lines)
+
+    # call stacks in the collapsed format read by flamegraph tools: one
+    # line per stack, with names separated by ';' and the stack's self
+    # time in microseconds
+    def collapsed_stacks(self):
+        lines = []
+        pending = [((), self.tree)]
+        while pending:
+            path, node = pending.pop()
+            if path and round(node[0] * 1e6):
+                lines.append('%s %d' % (';'.join(path), round(node[0] * 1e6)))
+            for (kind, name), child in node[1].items():
+                pending.append((path + (name,), child))
+        return '\n'.join(sorted(lines))
+
+''' 
+~~~~~~~~~~~~~~~~~~~~~~~~~ RESOURCE LIMITS ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# evaluations given a Budget raise ResourceLimitExceeded once they have
+# made too many calls, run past a deadline, built too many list cells or
+# nested too many calls
+# code compiled for a Budget charges every call to the Budget of the
+# evaluation running it, so functions defined in one evaluation are
+# charged to whichever evaluation calls them
+# code compiled without one, and all code run without one, is not
+# charged, so limits cost nothing when they are not used
+
+# Budget of the evaluation running on this thread
+class LimitState(threading.local):
+    budget = None
+
+limit_state = LimitState()
+
+# builtins whose results are lists with newly allocated cells
+list_builders = {list_init, concatenate, map_fun, filter_fun, pmap}
+
+# limits on the work evaluations may do, each unlimited if None
+# steps are calls to functions and builtins, seconds are counted from when
+# the Budget is made, cells are elements of lists built by builtins, and
+# depth is the number of nested calls not in tail position
+# a Budget keeps counting across every evaluation it is given to
+class Budget():
+    def __init__(self, steps = None, seconds = None, cells = None, depth = None):
+        self.max_steps = math.inf if steps is None else steps
+        self.deadline = math.inf if seconds is None else time.monotonic() + seconds
+        self.max_cells = math.inf if cells is None else cells
+        self.max_depth = math.inf if depth is None else depth
+        self.steps = 0
+        self.cells = 0
+        # calls currently running
+        self.depth = 0
+
+    # charges one call
+    # the clock is only read every 256 steps
+    def step(self):
+        self.steps += 1
+        if self.steps > self.max_steps:
+            raise ResourceLimitExceeded('steps')
+        if not self.steps & 255 and time.monotonic() > self.deadline:
+            raise ResourceLimitExceeded('time')
+
+    # makes evaluations using the budget stop, with a 'time' error, at
+    # their next check of the deadline
+    def cancel(self):
+        self.deadline = -math.inf
+
+    # charges a call of a function body, which runs one level deeper
+    def enter(self):
+        self.step()
+        if self.depth >= self.max_depth:
+            raise ResourceLimitExceeded('depth')
+        self.depth += 1
+
+    # calls a builtin, charging the cells of lists it builds
+    def call(self, function, params):
+        result = function(params)
+        if function in list_builders and isinstance(result, LinkedList) and not any(result is param for param in params):
+            self.cells += len(result)
+            if self.cells > self.max_cells:
+                raise ResourceLimitExceeded('cells')
+        return result
+
+# function call compiled for a Budget
+# calls to builtins are charged here, while Functions and VMFunctions
+# charge themselves, which also covers those compiled without a Budget
+def compile_metered_call(parsed, scope, tail):
+    get_operation = compile_expression(parsed[0], scope)
+    operands = [compile_expression(expression, scope) for expression in parsed[1:]]
+    def run_call(env):
+        operation = get_operation(env)
+        params = [operand(env) for operand in operands]
+        if type(operation) is Function:
+            if tail:
+                return TailCall(operation, params)
+            return operation(params)
+        budget = limit_state.budget
+        if budget is None:
+            return operation(params)
+        # VMFunctions charge their own calls too
+        if type(operation) is not VMFunction:
+            budget.step()
+        return budget.call(operation, params)
+    return run_call
+
+''' 
+~~~~~~~~~~~~~~~~~~~~~~~~~ PARSE CACHE ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# with cache, the parsed expressions of each file run by evaluate_file are
+# cached in a __carlaecache__ directory next to it, like python's
+# __pycache__, so later runs do not have to read the source again
+# caching is off unless asked for, as lab.py does for the files it loads,
+# since a cached file's expressions are all held in memory at once
+# a cache file is used if the source's modification time and size match
+# it, or else if the hash of the source's contents does
+# cached expressions are stored as plain lists and tuples, which marshal
+# can store, and keep the positions of Expressions
+
+CACHE_DIRECTORY = '__carlaecache__'
+# starts every cache file, and changes whenever their format does
+CACHE_MAGIC = b'CRLC\x02'
+# sources larger than this many bytes are never cached
+CACHE_MAX_SIZE = 1 << 20
+
+def cache_path(file_name):
+    directory, base = os.path.split(os.path.abspath(file_name))
+    return os.path.join(directory, CACHE_DIRECTORY, base + 'c')
+
+# copy of a parsed expression that marshal can store
+# Expressions become (line, column, terms) tuples, and other lists lists
+def stored_expression(parsed):
+    if isinstance(parsed, Expression):
+        return (parsed.line, parsed.column, [stored_expression(expression) for expression in parsed])
+    if isinstance(parsed, list):
+        return [stored_expression(expression) for expression in parsed]
+    return parsed
+
+# parsed expression a stored_expression was made from
+def restored_expression(stored):
+    if isinstance(stored, tuple):
+        line, column, terms = stored
+        expression = Expression(restored_expression(term) for term in terms)
+        expression.line = line
+        expression.column = column
+        return expression
+    if isinstance(stored, list):
+        return [restored_expression(term) for term in stored]
+    return stored
+
+# cached expressions of file_name, as stored_expressions, or None if there
+# are none that are still valid
+def load_cached_expressions(file_name):
+    path = os.path.abspath(file_name)
+    try:
+        stat = os.stat(path)
+        with open(cache_path(path), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if not data.startswith(CACHE_MAGIC):
+        return None
+    try:
+        cached_path, mtime, size, digest, expressions = marshal.loads(data[len(CACHE_MAGIC):])
+    except (EOFError, ValueError, TypeError):
+        return None
+    if cached_path != path:
+        return None
+    if mtime == stat.st_mtime_ns and size == stat.st_size:
+        return expressions
+    # the source was touched or copied, but its contents may be the same
+    with open(path, 'r') as f:
+        if hashlib.sha256(f.read().encode()).hexdigest() != digest:
+            return None
+    store_cached_expressions(path, stat, digest, expressions)
+    return expressions
+
+# writes the cache file of file_name, whose source had the given os.stat
+# result and hash when expressions were read from it
+# sources that cannot be cached, because their directory is read-only or
+# their expressions are too deeply nested to store, are skipped
+def store_cached_expressions(file_name, stat, digest, expressions):
+    path = cache_path(file_name)
+    try:
+        data = marshal.dumps((os.path.abspath(file_name), stat.st_mtime_ns, stat.st_size, digest, expressions))
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        # written under another name first, so readers never see part of it
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(CACHE_MAGIC + data)
+        os.replace(temp_path, path)
+    except (OSError, ValueError, RecursionError):
+        pass
+
+# yields the expressions of a source file as they are read
+# with cache, their stored forms are also kept and cached once the whole
+# file has been read, so a file is only cached if everything in it could be
+# run
+# files over CACHE_MAX_SIZE are only streamed
+def read_source_file(file_name, cache = False):
+    stat = os.stat(file_name) if cache else None
+    if stat is None or stat.st_size > CACHE_MAX_SIZE:
+        with open(file_name, 'r') as my_file:
+            yield from read_expressions(read_chunks(my_file))
+        return
+    digest = hashlib.sha256()
+    stored = []
+    def hashed(chunks):
+        for chunk in chunks:
+            digest.update(chunk.encode())
+            yield chunk
+    with open(file_name, 'r') as my_file:
+        for expression in read_expressions(hashed(read_chunks(my_file))):
+            # expressions too deeply nested to store leave the file uncached
+            if stored is not None:
+                try:
+                    stored.append(stored_expression(expression))
+                except RecursionError:
+                    stored = None
+            yield expression
+    if stored is not None:
+        store_cached_expressions(file_name, stat, digest.hexdigest(), stored)
+
+''' 
+~~~~~~~~~~~~~~~~~~~~~~~~~ EVALUATION FUNCTIONS ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''     
+
+# evaluates expression by compiling it and running the compiled code
+# constants are folded first, for either backend
+# with a profiler, the expression is compiled to report to it
+# with vm, the expression is compiled to bytecode and run by the VM, which
+# does not support profiling
+# with a budget, evaluation raises ResourceLimitExceeded once it runs out;
+# budgets cannot be combined with profiling
+def result_and_env(parsed, env = None, profiler = None, vm = False, budget = None):
+    if env is None:
+        env = Environment()
+    parsed = fold_constants(parsed)
+    if budget is not None:
+        if profiler is not None:
+            raise ValueError('evaluations with a budget cannot be profiled')
+        return run_with_budget(parsed, env, vm, budget), env
+    if vm:
+        if profiler is not None:
+            raise ValueError('the bytecode VM cannot be profiled')
+        return run_bytecode(compile_bytecode(parsed), env), env
+    if profiler is None:
+        return compile_expression(parsed)(env), env
+    compile_state.profiler = profiler
+    try:
+        code = compile_expression(parsed)
+    finally:
+        compile_state.profiler = None
+    return code(env), env
+
+# compiles parsed to charge the budget, and runs it with the budget set
+# running out of python stack is reported as reaching the depth limit
+def run_with_budget(parsed, env, vm, budget):
+    previous = limit_state.budget
+    limit_state.budget = budget
+    # an earlier evaluation may have stopped inside calls
+    budget.depth = 0
+    try:
+        if vm:
+            return run_bytecode(compile_bytecode(parsed), env, budget)
+        compile_state.metered = True
+        try:
+            code = compile_expression(parsed)
+        finally:
+            compile_state.metered = False
+        return code(env)
+    except RecursionError:
+        raise ResourceLimitExceeded('depth') from None
+    finally:
+        limit_state.budget = previous
 
 # wrapper function
-def evaluate(parsed, env = None):
-    return result_and_env(parsed, env)[0]
+def evaluate(parsed, env = None, profiler = None, vm = False, budget = None):
+    return result_and_env(parsed, env, profiler, vm = vm, budget = budget)[0]
 
 # reading from file
-def evaluate_file(file_name, env = None):
-    my_file = open(file_name, 'r')
-    program = my_file.read()
-    my_file.close()
-    return result_and_env(parse(tokenize(program)), env)[0]
+# evaluates each top-level expression as soon as it has been read and
+# returns the value of the last one
+# with cache, expressions are loaded from the file's parse cache if it is
+# valid, and files that are read and run without errors are cached
+def evaluate_file(file_name, env = None, profiler = None, vm = False, cache = False, budget = None):
+    if env is None:
+        env = Environment()
+    stored = load_cached_expressions(file_name) if cache else None
+    if stored is not None:
+        expressions = (restored_expression(expression) for expression in stored)
+    else:
+        expressions = read_source_file(file_name, cache)
+    last_val = None
+    found = False
+    for expression in expressions:
+        last_val = evaluate(expression, env, profiler, vm = vm, budget = budget)
+        found = True
+    # raise error for files without any expressions
+    if not found:
+        raise SyntaxError
+    return last_val
 
 ''' 
 ~~~~~~~~~~~~~~~~~~~~~~~~~ REPL AND FILE LOADING ~~~~~~~~~~~~~~~~~~~~~~~~~
 '''     
 
 # for REPL/testing 
+# usage: lab.py [--vm] [--profile] [--flamegraph stacks.txt] [file ...]
+# --vm runs everything on the bytecode VM
+# --profile prints a profile of everything evaluated when the REPL quits,
+# and --flamegraph also writes it as collapsed stacks
 if __name__ == '__main__':
     # defining global environment
     env = Environment()
 
-    for file_name in sys.argv[1:]:
-        evaluate_file(file_name, env)
+    args = sys.argv[1:]
+    vm = '--vm' in args
+    if vm:
+        args.remove('--vm')
+    profiler = None
+    flamegraph_file = None
+    if vm and ('--flamegraph' in args or '--profile' in args):
+        sys.exit('lab.py: the bytecode VM cannot be profiled; use --profile or --flamegraph without --vm')
+    if '--flamegraph' in args:
+        index = args.index('--flamegraph')
+        flamegraph_file = args[index + 1]
+        del args[index:index + 2]
+        profiler = Profiler()
+    if '--profile' in args:
+        args.remove('--profile')
+        profiler = Profiler()
+
+    for file_name in args:
+        evaluate_file(file_name, env, profiler, vm = vm, cache = True)
 
     # REPL environment
     while True:
@@ -493,7 +2613,13 @@ if __name__ == '__main__':
             if program == 'quit':
                 break
             else:
-                value = evaluate(parse(tokenize(program)), env)
+                value = evaluate(parse(tokenize(program)), env, profiler, vm = vm)
                 print('out:\n', value, '\n')
         except:
             print('out:\ninvalid program\n')
+
+    if profiler is not None:
+        print(profiler.report())
+        if flamegraph_file is not None:
+            with open(flamegraph_file, 'w') as f:
+                f.write(profiler.collapsed_stacks() + '\n')
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import server
+
+LOADGEN_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# the first three test inputs are strings for the reader, not expressions
+READER_TESTS = {'1.json', '2.json', '3.json'}
+
+'''
+~~~~~~~~~~~~~~~~~~~~~~~~~ LOAD GENERATOR ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# (session, expressions) for every test_inputs file, repeated repeat times
+# each replay of a file gets a session of its own, so the definitions it
+# makes are its own as they are in test.py
+def load_sessions(repeat = 1):
+    directory = os.path.join(LOADGEN_DIRECTORY, 'test_inputs')
+    names = sorted((name for name in os.listdir(directory) if name.endswith('.json') and name not in READER_TESTS), key = lambda name: int(name[:-len('.json')]))
+    sessions = []
+    for name in names:
+        with open(os.path.join(directory, name)) as f:
+            expressions = json.load(f)
+        sessions += [('%s#%d' % (name, i), expressions) for i in range(repeat)]
+    return sessions
+
+async def connect(host, port, unix_path):
+    if unix_path is not None:
+        return await asyncio.open_unix_connection(unix_path, limit = 1 << 24)
+    return await asyncio.open_connection(host, port, limit = 1 << 24)
+
+# replays sessions from a queue over one connection, one request at a time
+# records (client latency, server latency, ok) for every request
+async def client(queue, host, port, unix_path, records):
+    reader, writer = await connect(host, port, unix_path)
+    try:
+        while not queue.empty():
+            session, expressions = queue.get_nowait()
+            for i, expression in enumerate(expressions):
+                start = time.perf_counter()
+                writer.write(json.dumps({'id': i, 'session': session, 'expression': expression}).encode() + b'\n')
+                await writer.drain()
+                response = json.loads(await reader.readline())
+                records.append((time.perf_counter() - start, response['latency'], response['ok']))
+    finally:
+        writer.close()
+
+# value at fraction q of sorted values
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+# replays every session over connections clients at once, returning a
+# summary of throughput and latencies in seconds
+async def replay(sessions, connections = 4, host = '127.0.0.1', port = 8765, unix_path = None):
+    queue = asyncio.Queue()
+    for session in sessions:
+        queue.put_nowait(session)
+    records = []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(queue, host, port, unix_path, records) for _ in range(connections)))
+    elapsed = time.perf_counter() - start
+    client_latencies = sorted(record[0] for record in records)
+    server_latencies = sorted(record[1] for record in records)
+    return {
+        'requests': len(records),
+        'errors': sum(1 for record in records if not record[2]),
+        'seconds': elapsed,
+        'throughput': len(records) / elapsed,
+        'latency': {q: percentile(client_latencies, p) for q, p in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1))},
+        'server_latency': {q: percentile(server_latencies, p) for q, p in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1))},
+    }
+
+'''
+~~~~~~~~~~~~~~~~~~~~~~~~~ COMMAND LINE ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# runs a server in this process when spawn is set, sharing the CPU with
+# the clients
+async def run(args):
+    sessions = load_sessions(args.repeat)
+    if not args.spawn:
+        return await replay(sessions, args.connections, args.host, args.port, args.unix)
+    listener = await server.EvaluationServer(args.workers).start()
+    async with listener:
+        port = listener.sockets[0].getsockname()[1]
+        return await replay(sessions, args.connections, '127.0.0.1', port)
+
+# usage: loadgen.py [--host H] [--port P | --unix PATH | --spawn [--workers N]]
+#                   [--connections N] [--repeat N]
+# prints the summary of a replay of test_inputs as JSON
+# errors are expected: the test inputs include expressions that should fail
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Replay test_inputs against a Carlae evaluation server')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--unix', default = None, help = 'connect to this unix socket instead of TCP')
+    parser.add_argument('--spawn', action = 'store_true', help = 'start a server in this process instead of connecting to one')
+    parser.add_argument('--workers', type = int, default = 4, help = 'workers of the spawned server')
+    parser.add_argument('--connections', type = int, default = 4, help = 'clients sending requests at the same time')
+    parser.add_argument('--repeat', type = int, default = 1, help = 'times each test input is replayed')
+    args = parser.parse_args(argv)
+    print(json.dumps(asyncio.run(run(args)), indent = 2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
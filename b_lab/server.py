@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import sys
+import time
+import lab
+from batch import json_value
+
+'''
+~~~~~~~~~~~~~~~~~~~~~~~~~ PROTOCOL ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# requests and responses are JSON objects, one per line
+# requests:
+#   {"id": ..., "session": ..., "source": "(+ 1 2)"}
+#       evaluates every expression in the source, giving the last value
+#   {"id": ..., "session": ..., "expression": ["+", 1, 2]}
+#       evaluates an expression already parsed, in the test_inputs format
+#   {"cancel": id}
+#       stops the request with that id sent on the same connection
+# responses, sent as requests finish, which may be out of order:
+#   {"id": ..., "ok": true, "value": ..., "latency": seconds}
+#   {"id": ..., "ok": false, "error": "EvaluationError", "latency": seconds}
+# every session has a global Environment of its own that lasts as long as
+# the server, and its requests are evaluated one at a time, in the order
+# they arrive, while other sessions' requests run alongside on the pool
+# a line longer than the server's request limit is answered with an
+# InvalidRequest error and skipped, and the connection stays open
+
+# bytes a request line may hold by default
+REQUEST_LIMIT = 1 << 24
+
+'''
+~~~~~~~~~~~~~~~~~~~~~~~~~ SERVER ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+class Session():
+    def __init__(self):
+        self.env = lab.Environment()
+        # held while one of the session's requests is evaluated
+        self.lock = asyncio.Lock()
+
+# state of a request that has not been answered yet
+class PendingRequest():
+    def __init__(self):
+        self.task = None
+        # true once the request is waiting for its session
+        self.waiting = False
+        # Budget of the evaluation, once it has started
+        self.budget = None
+        self.cancelled = False
+
+class EvaluationServer():
+    # evaluations run on a pool of worker threads, each with a Budget of
+    # the given limits (see lab.Budget)
+    # sessions' environments live in the server, and cancelled evaluations
+    # are stopped through their Budget, so workers are threads rather than
+    # processes
+    def __init__(self, workers = 4, steps = None, seconds = None, cells = None, depth = None, request_limit = REQUEST_LIMIT):
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+        self.limits = {'steps': steps, 'seconds': seconds, 'cells': cells, 'depth': depth}
+        self.request_limit = request_limit
+        # Session by id
+        self.sessions = {}
+
+    # runs on a worker thread
+    def evaluate(self, request, env, budget):
+        if 'source' in request:
+            expressions = lab.parse_program(request['source'])
+            if not expressions:
+                raise SyntaxError
+        else:
+            expressions = [request['expression']]
+        for expression in expressions:
+            value = lab.evaluate(expression, env, budget = budget)
+        return json_value(value)
+
+    async def run_request(self, request, pending, send):
+        start = time.perf_counter()
+        response = {'id': request.get('id')}
+        session = self.sessions.get(request.get('session'))
+        if session is None:
+            session = self.sessions[request.get('session')] = Session()
+        try:
+            if pending.cancelled:
+                raise asyncio.CancelledError
+            pending.waiting = True
+            async with session.lock:
+                pending.budget = lab.Budget(**self.limits)
+                value = await asyncio.get_running_loop().run_in_executor(self.pool, self.evaluate, request, session.env, pending.budget)
+            response.update(ok = True, value = value)
+        except asyncio.CancelledError:
+            response.update(ok = False, error = 'Cancelled')
+        except Exception as e:
+            response.update(ok = False, error = 'Cancelled' if pending.cancelled else type(e).__name__)
+        response['latency'] = time.perf_counter() - start
+        await send(response)
+
+    # a request waiting for its session is dropped, and a running one is
+    # stopped through its Budget, so the session is never left to two
+    # evaluations at once
+    @staticmethod
+    def cancel(pending):
+        pending.cancelled = True
+        if pending.budget is not None:
+            pending.budget.cancel()
+        elif pending.waiting:
+            pending.task.cancel()
+
+    # the next line from reader, b'' at the end of the stream, or None for a
+    # line longer than the reader's limit, which is read and dropped
+    @staticmethod
+    async def read_line(reader):
+        try:
+            return await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+        except asyncio.LimitOverrunError as e:
+            consumed = e.consumed
+        while True:
+            await reader.readexactly(consumed)
+            try:
+                await reader.readuntil(b'\n')
+                return None
+            except asyncio.IncompleteReadError:
+                return None
+            except asyncio.LimitOverrunError as e:
+                consumed = e.consumed
+
+    async def handle_connection(self, reader, writer):
+        # PendingRequest by request id
+        pending_requests = {}
+        send_lock = asyncio.Lock()
+        async def send(response):
+            async with send_lock:
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        # once answered, an id may be used again
+        def forget(key, pending):
+            def callback(task):
+                if pending_requests.get(key) is pending:
+                    del pending_requests[key]
+            return callback
+        tasks = set()
+        while True:
+            try:
+                line = await self.read_line(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                break
+            if line is None:
+                request = None
+            elif not line:
+                break
+            else:
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    request = None
+            if not isinstance(request, dict):
+                await send({'id': None, 'ok': False, 'error': 'InvalidRequest'})
+                continue
+            if 'cancel' in request:
+                if request['cancel'] in pending_requests:
+                    self.cancel(pending_requests[request['cancel']])
+                continue
+            key = request.get('id')
+            pending = pending_requests[key] = PendingRequest()
+            pending.task = asyncio.create_task(self.run_request(request, pending, send))
+            tasks.add(pending.task)
+            pending.task.add_done_callback(tasks.discard)
+            pending.task.add_done_callback(forget(key, pending))
+        # the client has gone, so nothing it asked for is worth finishing
+        for pending in list(pending_requests.values()):
+            self.cancel(pending)
+        await asyncio.gather(*tasks, return_exceptions = True)
+        writer.close()
+
+    async def start(self, host = '127.0.0.1', port = 0, unix_path = None):
+        if unix_path is not None:
+            return await asyncio.start_unix_server(self.handle_connection, unix_path, limit = self.request_limit)
+        return await asyncio.start_server(self.handle_connection, host, port, limit = self.request_limit)
+
+'''
+~~~~~~~~~~~~~~~~~~~~~~~~~ COMMAND LINE ~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# usage: server.py [--host H] [--port P | --unix PATH] [--workers N]
+#                  [--max-steps N] [--timeout SECONDS] [--max-cells N] [--max-depth N]
+#                  [--max-request BYTES]
+async def serve(args):
+    server = EvaluationServer(args.workers, args.max_steps, args.timeout, args.max_cells, args.max_depth, args.max_request)
+    listener = await server.start(args.host, args.port, args.unix)
+    addresses = ', '.join(str(sock.getsockname()) for sock in listener.sockets)
+    print('serving on %s' % addresses, file = sys.stderr, flush = True)
+    async with listener:
+        await listener.serve_forever()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Carlae evaluation server speaking JSON lines')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--unix', default = None, help = 'listen on this unix socket instead of TCP')
+    parser.add_argument('--workers', type = int, default = 4, help = 'evaluations run at the same time')
+    parser.add_argument('--max-steps', type = int, default = None)
+    parser.add_argument('--timeout', type = float, default = None, help = 'seconds each request may run for')
+    parser.add_argument('--max-cells', type = int, default = None)
+    parser.add_argument('--max-depth', type = int, default = None)
+    parser.add_argument('--max-request', type = int, default = REQUEST_LIMIT, help = 'bytes a request line may hold')
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
+import io
 import os
 import lab
 import sys
 import json
+import tempfile
+import threading
 import unittest
 
 TEST_DIRECTORY = os.path.dirname(__file__)
@@ -349,5 +352,786 @@ class Test8_RealPrograms(LispTest):
         self._test_continued_evaluations(72)
 
 
+class Test9_SourceReader(LispTest):
+    def test_reader_matches_parse(self):
+        inp, out = self.load_test_values(3)
+        for program, expected in zip(inp, out):
+            if expected['ok']:
+                self.assertEqual(lab.parse_program(program), [expected['output']])
+            else:
+                self.assertRaises(SyntaxError, lab.parse_program, program)
+
+    def test_reader_positions(self):
+        first, second = lab.parse_program('(define x 2) ; one\n  (+ x\n (* x 3))')
+        self.assertEqual((first.line, first.column), (1, 1))
+        self.assertEqual((second.line, second.column), (2, 3))
+        self.assertEqual((second[2].line, second[2].column), (3, 2))
+
+    def test_reader_interning(self):
+        first = lab.parse_program('(define (f x) (+ x 1.5))')[0]
+        second = lab.parse(lab.tokenize('(f (+ 1.5 x))'))
+        # symbols are the same object in every program read
+        self.assertIs(first[1][0], second[0])
+        self.assertIs(first[2][1], second[1][2])
+        # equal numbers within a program are one object
+        numbers = lab.parse_program('(list 1.5 1.5)')[0]
+        self.assertIs(numbers[1], numbers[2])
+        self.assertEqual([lab.parse_atom(token) for token in ['-', '-5', '+.5', '1_000', 'nan', '1e5', '-x']],
+                         ['-', -5, 0.5, 1000, 'nan', '1e5', '-x'])
+
+    def test_reader_deep_nesting(self):
+        depth = 100000
+        parsed = lab.parse_program('(' * depth + 'x' + ')' * depth)[0]
+        for _ in range(depth - 1):
+            parsed = parsed[0]
+        self.assertEqual(parsed, ['x'])
+        self.assertEqual(len(lab.parse(['('] * depth + [')'] * depth)), 1)
+
+    def test_reader_chunk_boundaries(self):
+        with open(os.path.join('test_files', 'definitions.crl')) as f:
+            program = f.read()
+        for chunk_size in (1, 7, 64):
+            chunks = lab.read_chunks(io.StringIO(program), chunk_size)
+            self.assertEqual(list(lab.read_expressions(chunks)), lab.parse_program(program))
+
+    def test_multiple_expression_file(self):
+        _, out = self.load_test_values(72)
+        result = list_from_ll(lab.evaluate_file(os.path.join('carlae_code', '72.crl')))
+        self.assertAlmostEqual(result, out[-1]['output'])
+
+
+class Test10_TailCalls(LispTest):
+    def test_tail_recursion(self):
+        env = lab.Environment()
+        for program in [
+            '(define (count n acc) (if (=? n 0) acc (count (- n 1) (+ acc 1))))',
+            '(define (even? n) (if (=? n 0) #t (odd? (- n 1))))',
+            '(define (odd? n) (if (=? n 0) #f (even? (- n 1))))',
+            '(define (loop n) (begin (define m (- n 1)) (let ((k m)) (if (> k 0) (loop k) n))))',
+        ]:
+            lab.evaluate(lab.parse(lab.tokenize(program)), env)
+        self.assertEqual(lab.evaluate(['count', 50000, 0], env), 50000)
+        self.assertEqual(lab.evaluate(['even?', 50001], env), False)
+        self.assertEqual(lab.evaluate(['loop', 50000], env), 1)
+
+
+class Test11_LexicalAddressing(LispTest):
+    def test_frame_fallbacks(self):
+        env = lab.Environment()
+        cases = [
+            ('(define x 1)', 1),
+            ('(define (f c) (begin (if c (define x 2) 0) x))', 'SOMETHING'),
+            ('(f #f)', 1),
+            ('(f #t)', 2),
+            ('(let ((x (+ x 1)) (y x)) (list x y))', [2, 2]),
+            ('(define (g) (let ((a 1)) (begin (define b 5) (+ a b))))', 'SOMETHING'),
+            ('(g)', 6),
+            ('(define (r) (begin (set! x 5) (define x 3) x))', 'SOMETHING'),
+            ('(r)', 3),
+            ('x', 5),
+            ('(define (h x x) x)', 'SOMETHING'),
+            ('(h 1 2)', 2),
+        ]
+        for program, expected in cases:
+            result = lab.evaluate(lab.parse(lab.tokenize(program)), env)
+            self.assertEqual(list_from_ll(result), expected)
+
+    def test_defines_of_bound_names(self):
+        env = lab.Environment()
+        cases = [
+            ('(define x 100)', 100),
+            ('(define (f x) (begin (define x (+ x 1)) x))', 'SOMETHING'),
+            ('(f 4)', 5),
+            ('x', 100),
+            ('(define (k y) (if (> y 0) y (define y 5)))', 'SOMETHING'),
+            ('(k 3)', 3),
+            ('(k 0)', 5),
+            ('(define (d z z) (begin (define z (+ z 1)) z))', 'SOMETHING'),
+            ('(d 1 2)', 3),
+            ('(let ((y 1)) (begin (define y (+ y 1)) y))', 2),
+            ('(define (g a) (let ((y a)) (begin (define y (* y 10)) (+ y a))))', 'SOMETHING'),
+            ('(g 2)', 22),
+        ]
+        for program, expected in cases:
+            result = lab.evaluate(lab.parse(lab.tokenize(program)), env)
+            self.assertEqual(list_from_ll(result), expected, program)
+
+
+class Test12_ArrayLists(LispTest):
+    def test_views(self):
+        env = lab.Environment()
+        lab.evaluate(['define', 'x', ['list'] + list(range(20000))], env)
+        self.assertEqual(lab.evaluate(['length', 'x'], env), 20000)
+        self.assertEqual(lab.evaluate(['elt-at-index', 'x', 19999], env), 19999)
+        self.assertEqual(lab.evaluate(['elt-at-index', ['cdr', ['cdr', 'x']], 0], env), 2)
+        self.assertEqual(lab.evaluate(['length', ['cdr', 'x']], env), 19999)
+        rest = lab.evaluate(['cdr', 'x'], env)
+        self.assertIs(rest.items, lab.evaluate('x', env).items)
+        self.assertIsInstance(rest, lab.LinkedList)
+        self.assertEqual(list_from_ll(lab.evaluate(['list', 1, 2], env).next), [2])
+        self.assertIsNone(lab.evaluate(['cdr', ['list', 1]], env))
+
+    def test_long_lists(self):
+        env = lab.Environment()
+        lab.evaluate(['define', 'x', ['list'] + list(range(100000))], env)
+        program = '(length (concat (map (lambda (n) (* n 2)) x) (filter (lambda (n) (> n 49999)) x) x))'
+        self.assertEqual(lab.evaluate(lab.parse(lab.tokenize(program)), env), 250000)
+        self.assertEqual(lab.evaluate(['reduce', '+', ['map', '-', 'x'], 0], env), -4999950000)
+        self.assertIs(lab.evaluate(['concat', ['list'], 'x', ['list']], env), lab.evaluate('x', env))
+        self.assertIsNone(lab.evaluate(['filter', ['lambda', ['n'], ['<', 'n', 0]], 'x'], env))
+
+
+class Test13_NumberLists(LispTest):
+    def test_bulk_builtins_match_calls(self):
+        env = lab.Environment()
+        lab.evaluate(['define', 'x', ['list'] + [(i * 7919) % 2001 - 1000 for i in range(3000)] + [0]], env)
+        lab.evaluate(['define', 'big', ['list', 2 ** 62, 2 ** 70, -3]], env)
+        self.assertIsInstance(lab.evaluate('x', env), lab.NumberList)
+        for func, numbers, init in [('map', 'x', None), ('filter', 'x', None), ('reduce', 'x', 7),
+                                    ('map', 'big', None), ('reduce', 'big', 2 ** 62)]:
+            for op in ['+', '-', '*', '/', '<', '=?', 'not']:
+                if func == 'reduce' and op not in '+-*':
+                    continue
+                params = ['a'] if init is None else ['a', 'b']
+                wrapped = ['lambda', params, [op] + params]
+                extra = [] if init is None else [init]
+                fast = lab.evaluate([func, op, numbers] + extra, env)
+                slow = lab.evaluate([func, wrapped, numbers] + extra, env)
+                if isinstance(slow, lab.LinkedList):
+                    fast, slow = list(fast), list(slow)
+                self.assertEqual(fast, slow)
+                self.assertEqual([type(v) for v in fast] if isinstance(fast, list) else type(fast),
+                                 [type(v) for v in slow] if isinstance(slow, list) else type(slow))
+
+
+class Test14_Comparisons(LispTest):
+    def test_matches_sorting(self):
+        values = [[], [1], [1, 2], [2, 1], [1, 1], [3, 2, 2], [1, 2.5, 3], [3, 2, 1], [1, 3, 2], [True, 0]]
+        for args in values:
+            self.assertEqual(lab.greater_than(list(args)), args == sorted(set(args), reverse=True))
+            self.assertEqual(lab.greater_than_equal(list(args)), args == sorted(args, reverse=True))
+            self.assertEqual(lab.less_than(list(args)), args == sorted(set(args)))
+            self.assertEqual(lab.less_than_equal(list(args)), args == sorted(args))
+            if len(args) == 2:
+                env = lab.Environment()
+                for op in ['<', '<=', '>', '>=', '=?']:
+                    builtin = lab.carlae_builtins[op]
+                    self.assertEqual(lab.evaluate([op] + args, env), builtin(list(args)))
+
+class Test15_Profiler(LispTest):
+    def test_counts(self):
+        profiler = lab.Profiler()
+        env = lab.Environment()
+        program = lab.parse_program('''
+            (define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+            (define (count n) (if (=? n 0) 0 (count (- n 1))))
+            (fib 10)
+            (count 5000)
+            (map (lambda (x) (* x 2)) (list 1 2 3))
+        ''')
+        values = [lab.evaluate(expression, env, profiler) for expression in program]
+        self.assertEqual(values[2:4], [55, 0])
+        self.assertEqual(list_from_ll(values[4]), [2, 4, 6])
+        calls = {key: stats[0] for key, stats in profiler.stats.items()}
+        self.assertEqual(calls[('function', 'fib')], 177)
+        self.assertEqual(calls[('function', 'count')], 5001)
+        self.assertEqual(calls[('function', 'lambda@6:18')], 3)
+        self.assertEqual(calls[('builtin', 'map')], 1)
+        self.assertEqual(calls[('builtin', '=?')], 5001)
+        self.assertEqual(calls[('form', 'define')], 2)
+        self.assertEqual(calls[('form', 'if')], 177 + 5001)
+        self.assertEqual(profiler.stack, [])
+        for calls, cumulative, self_time in profiler.stats.values():
+            self.assertLessEqual(self_time, cumulative + 1e-9)
+        stacks = dict(line.rsplit(' ', 1) for line in profiler.collapsed_stacks().split('\n'))
+        self.assertIn('fib;if;fib;if;fib', stacks)
+        self.assertIn('map;lambda@6:18', stacks)
+
+    def test_errors_and_unprofiled_code(self):
+        profiler = lab.Profiler()
+        env = lab.Environment()
+        lab.evaluate(['define', ['f', 'x'], ['car', 'x']], env)
+        self.assertRaises(lab.EvaluationError, lab.evaluate, ['car', ['list']], env, profiler)
+        self.assertRaises(lab.EvaluationError, lab.evaluate, ['f', ['list']], env, profiler)
+        self.assertEqual(profiler.stack, [])
+        # f was compiled without the profiler, so neither it nor the car it
+        # calls report anything
+        self.assertNotIn(('function', 'f'), profiler.stats)
+        self.assertEqual(profiler.stats[('builtin', 'car')][0], 1)
+        self.assertEqual(lab.evaluate(['f', ['list', 4]], env), 4)
+
+class Test16_VirtualMachine(LispTest):
+    def test_deep_recursion(self):
+        env = lab.Environment()
+        lab.evaluate(lab.parse(lab.tokenize('(define (sum-to n) (if (=? n 0) 0 (+ n (sum-to (- n 1)))))')), env, vm=True)
+        # calls between compiled functions do not use the python stack
+        self.assertEqual(lab.evaluate(['sum-to', 20000], env, vm=True), 200010000)
+
+    def test_runaway_recursion(self):
+        env = lab.Environment()
+        lab.evaluate(lab.parse(lab.tokenize('(define (f n) (+ 1 (f n)))')), env, vm=True)
+        self.assertRaises(RecursionError, lab.evaluate, ['f', 0], env, vm=True)
+        with self.assertRaises(lab.ResourceLimitExceeded) as caught:
+            lab.evaluate(['f', 0], env, vm=True, budget=lab.Budget())
+        self.assertEqual(caught.exception.resource, 'depth')
+
+    def test_mixed_backends(self):
+        env = lab.Environment()
+        lab.evaluate(['define', ['twice', 'f', 'x'], ['f', ['f', 'x']]], env, vm=True)
+        lab.evaluate(['define', ['inc', 'x'], ['+', 'x', 1]], env)
+        self.assertEqual(lab.evaluate(['twice', 'inc', 5], env), 7)
+        self.assertEqual(lab.evaluate(['twice', 'inc', 5], env, vm=True), 7)
+        self.assertEqual(list_from_ll(lab.evaluate(['map', ['lambda', ['x'], ['twice', 'inc', 'x']], ['list', 1, 2]], env, vm=True)), [3, 4])
+        self.assertRaises(ValueError, lab.evaluate, 'x', env, lab.Profiler(), vm=True)
+
+    def test_disassemble(self):
+        listing = lab.disassemble(lab.compile_bytecode(['if', ['<', 'x', 1], 2, 3]))
+        self.assertEqual(listing.split('\n')[0].split()[:2], ['0', 'NAME'])
+        self.assertIn('JUMP_IF_FALSE', listing)
+
+
+class Test17_ParseCache(LispTest):
+    def test_cache_reuse_and_invalidation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, 'library.crl')
+            with open(file_name, 'w') as f:
+                f.write('(define (double x) (* 2 x))\n(double 21)\n')
+            # caching is asked for
+            self.assertEqual(lab.evaluate_file(file_name), 42)
+            self.assertFalse(os.path.exists(os.path.join(directory, lab.CACHE_DIRECTORY)))
+            self.assertEqual(lab.evaluate_file(file_name, cache=True), 42)
+            self.assertTrue(os.path.exists(lab.cache_path(file_name)))
+            expressions = [lab.restored_expression(stored) for stored in lab.load_cached_expressions(file_name)]
+            self.assertEqual(expressions, [['define', ['double', 'x'], ['*', 2, 'x']], ['double', 21]])
+            # positions are cached with the expressions
+            self.assertEqual([(expression.line, expression.column) for expression in expressions], [(1, 1), (2, 1)])
+            self.assertEqual((expressions[0][1].line, expressions[0][1].column), (1, 9))
+            self.assertEqual(lab.evaluate_file(file_name, cache=True), 42)
+            # touched without changing, so the contents' hash still matches
+            os.utime(file_name, ns=(0, 0))
+            self.assertIsNotNone(lab.load_cached_expressions(file_name))
+            with open(file_name, 'w') as f:
+                f.write('(define (double x) (* 2 x))\n(double 5)\n')
+            os.utime(file_name, ns=(0, 0))
+            self.assertIsNone(lab.load_cached_expressions(file_name))
+            self.assertEqual(lab.evaluate_file(file_name, cache=True), 10)
+            self.assertEqual(lab.evaluate_file(file_name), 10)
+            # files that stop with an error are not cached
+            os.remove(lab.cache_path(file_name))
+            with open(file_name, 'w') as f:
+                f.write('(define x 1)\n(car x)\n')
+            self.assertRaises(Exception, lab.evaluate_file, file_name, cache=True)
+            self.assertFalse(os.path.exists(lab.cache_path(file_name)))
+
+    def test_large_files_not_cached(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, 'large.crl')
+            with open(file_name, 'w') as f:
+                f.write('(define x 1)\n' * 100 + 'x\n')
+            size = lab.CACHE_MAX_SIZE
+            lab.CACHE_MAX_SIZE = 1000
+            try:
+                self.assertEqual(lab.evaluate_file(file_name, cache=True), 1)
+            finally:
+                lab.CACHE_MAX_SIZE = size
+            self.assertFalse(os.path.exists(lab.cache_path(file_name)))
+
+
+class Test18_Memoize(LispTest):
+    def test_memoized_recursion(self):
+        env = lab.Environment()
+        program = '(define fib (memoize (lambda (n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))))'
+        lab.evaluate(lab.parse(lab.tokenize(program)), env)
+        self.assertEqual(lab.evaluate(['fib', 80], env), 23416728348467685)
+        fib = lab.evaluate('fib', env)
+        self.assertEqual(fib.cache_info(), {'hits': 78, 'misses': 81, 'max_size': lab.MEMOIZE_SIZE, 'size': 81})
+        fib.cache_clear()
+        self.assertEqual(fib.cache_info()['size'], 0)
+
+    def test_keys_and_eviction(self):
+        env = lab.Environment()
+        lab.evaluate(['define', 'calls', 0], env)
+        lab.evaluate(['define', 'f', ['memoize', ['lambda', ['x'], ['begin', ['set!', 'calls', ['+', 'calls', 1]], 'x']], 2]], env)
+        for arg in [1, 1.0, '#t', 1, ['list', 1, 2], ['list', 1, 2], ['list', ['list', 1], 2]]:
+            lab.evaluate(['f', arg], env)
+        # 1, 1.0 and #t are told apart, and equal lists share an entry
+        self.assertEqual(lab.evaluate('calls', env), 6)
+        self.assertIs(lab.evaluate(['f', '#t'], env), True)
+        self.assertEqual(lab.evaluate('calls', env), 7)
+        info = lab.evaluate('f', env).cache_info()
+        self.assertEqual((info['hits'], info['misses'], info['size']), (1, 7, 2))
+        for program in [['memoize', 1], ['memoize', '+', 0], ['memoize', '+', 1.5], ['memoize']]:
+            self.assertRaises(lab.EvaluationError, lab.evaluate, program, env)
+        self.assertRaises(lab.EvaluationError, lab.evaluate, [['memoize', ['lambda', ['x'], 'x']], 1, 2], env)
+
+
+class Test19_SharedPrograms(LispTest):
+    def test_programs_are_not_modified(self):
+        for n in range(4, 73):
+            if not os.path.exists('test_inputs/%s.json' % n):
+                continue
+            inputs, _ = self.load_test_values(n)
+            for vm in (False, True):
+                programs = json.loads(json.dumps(inputs))
+                env = lab.Environment()
+                for program in programs:
+                    try:
+                        lab.evaluate(program, env, vm=vm)
+                    except Exception:
+                        pass
+                self.assertEqual(programs, inputs)
+        program = ['lambda', ['x'], 'x']
+        self.assertIsNot(lab.evaluate(program).params, program[1])
+
+    def test_program_shared_between_threads(self):
+        program = lab.parse_program('''
+            (define (make-counter) (let ((n 0)) (lambda () (begin (set! n (+ n 1)) n))))
+            (define count (make-counter))
+            (define (loop k) (if (=? k 0) (count) (begin (count) (loop (- k 1)))))
+            (loop 2000)
+        ''')
+        code = [lab.compile_expression(expression) for expression in program]
+        def run(results, index):
+            env = lab.Environment()
+            for expression in code:
+                value = expression(env)
+            results[index] = value
+        results = [None] * 4
+        threads = [threading.Thread(target=run, args=(results, i)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [2001] * 4)
+
+
+class Test20_BatchRunner(LispTest):
+    def test_batch(self):
+        import batch
+        with tempfile.TemporaryDirectory() as directory:
+            jobs = {}
+            for name, contents in [('loop.crl', '(define (f) (f))\n(f)\n'),
+                                   ('square.crl', '(define (sq x) (* x x))\n(list (sq 3) (sq 4))\n'),
+                                   ('sequence.json', '[["define", "x", 2], ["car", ["list"]], ["+", "x", 1]]')]:
+                jobs[name] = os.path.join(directory, name)
+                with open(jobs[name], 'w') as f:
+                    f.write(contents)
+            results = {os.path.basename(result['job']): result for result in batch.run_batch(sorted(jobs.values()), workers=2, timeout=0.5)}
+        self.assertEqual((results['loop.crl']['ok'], results['loop.crl']['error']), (False, 'Timeout'))
+        self.assertEqual(results['square.crl']['value'], [9, 16])
+        self.assertEqual(results['sequence.json']['results'], [{'ok': True, 'output': 2}, {'ok': False, 'type': 'EvaluationError'}, {'ok': True, 'output': 3}])
+
+
+class Test21_ParallelMap(LispTest):
+    def setUp(self):
+        self.settings = lab.PMAP_WORKERS, lab.PMAP_MIN_LENGTH
+        lab.PMAP_WORKERS, lab.PMAP_MIN_LENGTH = 2, 10
+
+    def tearDown(self):
+        lab.PMAP_WORKERS, lab.PMAP_MIN_LENGTH = self.settings
+        if lab.pmap_pool is not None:
+            lab.pmap_pool.shutdown()
+            lab.pmap_pool = None
+
+    def test_matches_map(self):
+        env = lab.Environment()
+        for program in lab.parse_program('''
+            (define scale 3)
+            (define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+            (define (work x) (let ((y (* scale x))) (+ y (fib 10))))
+            (define (make-adder k) (lambda (x) (list x (+ x k))))
+            (define nums (list 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20))
+            (define calls 0)
+            (define (tick x) (begin (set! calls (+ calls 1)) x))
+            (define (ticks x) (tick (* 2 x)))
+        '''):
+            lab.evaluate(program, env)
+        for vm in (False, True):
+            for func in ['work', ['make-adder', 5], ['lambda', ['x'], ['lambda', ['y'], ['+', 'x', 'y']]], 'tick', 'ticks', '-']:
+                parallel = lab.evaluate(['pmap', func, 'nums'], env, vm=vm)
+                sequential = lab.evaluate(['map', func, 'nums'], env, vm=vm)
+                # functions in the results are compared by what they return
+                functions = (lab.Function, lab.VMFunction)
+                values = [lab.evaluate([v, 1], env) if isinstance(v, functions) else v for v in parallel]
+                expected = [lab.evaluate([v, 1], env) if isinstance(v, functions) else v for v in sequential]
+                self.assertEqual([list_from_ll(v) for v in values], [list_from_ll(v) for v in expected])
+        self.assertIsNotNone(lab.pmap_pool)
+        # functions using set! ran here, so calls counted every element
+        self.assertEqual(lab.evaluate('calls', env), 4 * 2 * 20)
+        self.assertRaises(lab.EvaluationError, lab.evaluate, ['pmap', ['lambda', ['x'], ['car', ['list']]], 'nums'], env)
+        self.assertEqual(list_from_ll(lab.evaluate(['pmap', 'work', ['list', 1, 2]], env)), [58, 61])
+
+
+class Test22_ResourceLimits(LispTest):
+    def test_limits(self):
+        for vm in (False, True):
+            env = lab.Environment()
+            for program in lab.parse_program('''
+                (define (loop) (loop))
+                (define (sum-to n) (if (=? n 0) 0 (+ n (sum-to (- n 1)))))
+                (define (grow n acc) (if (=? n 0) acc (grow (- n 1) (concat acc acc))))
+            '''):
+                lab.evaluate(program, env, vm=vm, budget=lab.Budget())
+            for program, limits, resource in [('(loop)', {'steps': 10000}, 'steps'),
+                                              ('(loop)', {'seconds': 0.05}, 'time'),
+                                              ('(sum-to 1000)', {'depth': 50}, 'depth'),
+                                              ('(grow 40 (list 1))', {'cells': 10000}, 'cells'),
+                                              ('(map (lambda (x) (loop)) (list 1 2))', {'steps': 100}, 'steps')]:
+                with self.assertRaises(lab.ResourceLimitExceeded) as caught:
+                    lab.evaluate(lab.parse(lab.tokenize(program)), env, vm=vm, budget=lab.Budget(**limits))
+                self.assertEqual(caught.exception.resource, resource)
+                self.assertIsInstance(caught.exception, lab.EvaluationError)
+            budget = lab.Budget(steps=1000, depth=50, cells=200)
+            self.assertEqual(lab.evaluate(['sum-to', 40], env, vm=vm, budget=budget), 820)
+            # 41 calls of sum-to, and the =?, - and + calls they make
+            self.assertEqual(budget.steps, 41 + 40 * 3 + 1)
+            self.assertEqual(lab.evaluate(['length', ['grow', 5, ['list', 1, 2]]], env, vm=vm, budget=budget), 64)
+            self.assertEqual(budget.cells, 2 + 4 + 8 + 16 + 32 + 64)
+            self.assertIsNone(lab.limit_state.budget)
+            # without a budget, code compiled for one is not limited
+            self.assertEqual(lab.evaluate(['sum-to', 60], env, vm=vm), 1830)
+
+    def test_functions_defined_without_budget(self):
+        for define_vm in (False, True):
+            for vm in (False, True):
+                env = lab.Environment()
+                for program in lab.parse_program('''
+                    (define (loop n) (loop (+ n 1)))
+                    (define (sum-to n) (if (=? n 0) 0 (+ n (sum-to (- n 1)))))
+                    (define (grow n acc) (if (=? n 0) acc (grow (- n 1) (concat acc acc))))
+                    (define (work) (reduce + (map - (list 1 2 3)) 0))
+                '''):
+                    lab.evaluate(program, env, vm=define_vm)
+                for program, limits, resource in [('(loop 0)', {'steps': 1000, 'seconds': 5}, 'steps'),
+                                                  ('(length (grow 18 (list 1)))', {'cells': 1000}, 'cells'),
+                                                  ('(loop 0)', {'seconds': 0.05}, 'time'),
+                                                  ('(sum-to 1000)', {'depth': 50}, 'depth'),
+                                                  ('(map (lambda (x) (loop x)) (list 1 2))', {'steps': 100}, 'steps')]:
+                    with self.assertRaises(lab.ResourceLimitExceeded) as caught:
+                        lab.evaluate(lab.parse(lab.tokenize(program)), env, vm=vm, budget=lab.Budget(**limits))
+                    self.assertEqual(caught.exception.resource, resource)
+                self.assertEqual(lab.evaluate(['sum-to', 40], env, vm=vm, budget=lab.Budget(depth=50)), 820)
+                # builtins called by the function are charged as if it had
+                # been defined with the budget
+                budget = lab.Budget()
+                self.assertEqual(lab.evaluate(['work'], env, vm=vm, budget=budget), -6)
+                self.assertEqual(budget.steps, 4)
+
+
+class Test23_Server(LispTest):
+    def test_server(self):
+        import asyncio
+        import server
+        async def exchange():
+            listener = await server.EvaluationServer(workers=2).start()
+            port = listener.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            responses = {}
+            async def send(request, wait_for=None):
+                writer.write(json.dumps(request).encode() + b'\n')
+                while wait_for is not None and wait_for not in responses:
+                    response = json.loads(await asyncio.wait_for(reader.readline(), 10))
+                    responses[response['id']] = response
+            await send({'id': 1, 'session': 'a', 'source': '(define x 3) (define (loop) (loop))'}, 1)
+            await send({'id': 2, 'session': 'b', 'expression': ['define', 'x', 4]}, 2)
+            await send({'id': 3, 'session': 'a', 'source': '(loop)'})
+            # queued behind the loop in session a
+            await send({'id': 4, 'session': 'a', 'source': '(+ x 1)'})
+            # session b is not held up by session a
+            await send({'id': 5, 'session': 'b', 'source': '(list x (car (list)))'}, 5)
+            await send({'id': 6, 'session': 'b', 'source': '(list x x'}, 6)
+            self.assertNotIn(3, responses)
+            await send({'cancel': 3}, 4)
+            await send({'id': 7, 'session': 'a', 'expression': ['list', 'x', 'x']}, 7)
+            writer.write(b'[1, 2]\n')
+            invalid = json.loads(await asyncio.wait_for(reader.readline(), 10))
+            writer.close()
+            listener.close()
+            await listener.wait_closed()
+            return responses, invalid
+        responses, invalid = asyncio.run(exchange())
+        self.assertEqual(responses[1]['value'], '<Function>')
+        self.assertEqual(responses[2]['value'], 4)
+        self.assertEqual((responses[3]['ok'], responses[3]['error']), (False, 'Cancelled'))
+        self.assertEqual(responses[4]['value'], 4)
+        self.assertEqual(responses[5]['error'], 'EvaluationError')
+        self.assertEqual(responses[6]['error'], 'SyntaxError')
+        self.assertEqual(responses[7]['value'], [3, 3])
+        self.assertEqual(invalid, {'id': None, 'ok': False, 'error': 'InvalidRequest'})
+        for response in responses.values():
+            self.assertGreaterEqual(response['latency'], 0)
+
+    def test_long_requests(self):
+        import asyncio
+        import server
+        source = '(length (list %s))' % ' '.join(['1'] * 100000)
+        async def exchange(request_limit):
+            listener = await server.EvaluationServer(workers=1, request_limit=request_limit).start()
+            port = listener.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            responses = []
+            for request in [{'id': 1, 'session': 'a', 'source': source}, {'id': 2, 'session': 'a', 'source': '(+ 1 2)'}]:
+                writer.write(json.dumps(request).encode() + b'\n')
+                responses.append(json.loads(await asyncio.wait_for(reader.readline(), 10)))
+            writer.close()
+            listener.close()
+            await listener.wait_closed()
+            return [(response['id'], response.get('value', response.get('error'))) for response in responses]
+        self.assertEqual(asyncio.run(exchange(server.REQUEST_LIMIT)), [(1, 100000), (2, 3)])
+        # too long a line is skipped, and the connection kept
+        self.assertEqual(asyncio.run(exchange(1024)), [(None, 'InvalidRequest'), (2, 3)])
+
+
+class Test24_ConstantFolding(LispTest):
+    # earlier tests shadow builtins, which turns folding of them off
+    def setUp(self):
+        self.shadows = lab.builtin_shadows
+        lab.builtin_shadows = lab.BuiltinShadows()
+
+    def tearDown(self):
+        lab.builtin_shadows = self.shadows
+
+    def test_folding(self):
+        def folded(source):
+            result = lab.fold_constants(lab.parse(lab.tokenize(source)))
+            return result.expression if isinstance(result, lab.Folded) else result
+        self.assertEqual(folded('(* 2 (+ 1 2))'), 6)
+        self.assertEqual(folded('(if (< 1 2) a b)'), 'a')
+        self.assertEqual(folded('(and #t x)'), ['and', 'x'])
+        self.assertEqual(folded('(or x #t y)'), ['or', 'x', True])
+        self.assertEqual(folded('(let ((x 5) (y (f))) (+ x 1 y))'), ['let', [['y', ['f']]], ['+', 5, 1, 'y']])
+        self.assertEqual(folded('(let ((x (- 7 2))) (lambda () (+ x 1)))')[2].expression, 6)
+        # left as they are: errors, frames binding builtin names, vars that
+        # are assigned or called
+        for source in ['(/ 1 0)', '(lambda (+) (+ 1 2))', '(let ((x 5)) (begin (set! x 2) x))', '(let ((x 5)) (x))']:
+            program = lab.parse(lab.tokenize(source))
+            self.assertIs(lab.fold_constants(program), program)
+
+    def test_shadowed_builtins(self):
+        for vm in (False, True):
+            lab.builtin_shadows = lab.BuiltinShadows()
+            env = lab.Environment()
+            other = lab.Environment()
+            results = []
+            for program in lab.parse_program('''
+                (define (f) (+ 1 2))
+                (define (g) (if #t (* 2 3) 0))
+                (f)
+                (define + -)
+                (f)
+                (+ 1 2)
+                (define #t #f)
+                (g)
+                (begin (define * +) (* 2 3))
+            '''):
+                results.append(lab.evaluate(program, env, vm=vm))
+            self.assertEqual(results[2:], [3, lab.sub, -1, -1, False, 0, -1])
+            # other environments still see the builtins
+            self.assertEqual(lab.evaluate(['+', 1, 2], other, vm=vm), 3)
+
+    def test_defines_in_folded_expressions(self):
+        for vm in (False, True):
+            lab.builtin_shadows = lab.BuiltinShadows()
+            env = lab.Environment()
+            results = []
+            for program in lab.parse_program('''
+                (define (f) (begin (if #t (define y 1) 0) y))
+                (f)
+                (let ((a 1)) (begin (if #t (define y 2) 0) y))
+                (define (g) (begin (if (> 1 2) (define z 4) (define z 3)) z))
+                (g)
+                (define > <)
+                (g)
+            '''):
+                results.append(lab.evaluate(program, env, vm=vm))
+            self.assertEqual([results[1], results[2], results[4], results[6]], [1, 2, 3, 4])
+
+
+class Test25_SharedLists(LispTest):
+    def test_concat_shares_last_list(self):
+        env = lab.Environment()
+        for program in lab.parse_program('''
+            (define tail (list 3 4 5))
+            (define whole (concat (list 1) (list 2) tail))
+            (define mixed (concat (list 0.5) whole))
+            (define (build n acc) (if (=? n 0) acc (build (- n 1) (concat (list n) acc))))
+        '''):
+            lab.evaluate(program, env)
+        tail, whole, mixed = env.symbols['tail'], env.symbols['whole'], env.symbols['mixed']
+        self.assertIs(whole.rest, tail)
+        self.assertIs(whole.next.next, tail)
+        self.assertIsInstance(whole, lab.NumberList)
+        self.assertNotIsInstance(mixed, lab.NumberList)
+        self.assertEqual(list_from_ll(mixed), [0.5, 1, 2, 3, 4, 5])
+        self.assertEqual([lab.evaluate(['elt-at-index', 'mixed', i], env) for i in range(6)], [0.5, 1, 2, 3, 4, 5])
+        self.assertRaises(lab.EvaluationError, lab.evaluate, ['elt-at-index', 'mixed', 6], env)
+        self.assertEqual(lab.evaluate(['length', 'mixed'], env), 6)
+        self.assertEqual(lab.evaluate(['reduce', '-', ['map', '-', 'whole'], 0], env), 15)
+        self.assertEqual(list_from_ll(lab.evaluate(['filter', '-', ['concat', ['list', 0, 1], ['list', 0, 2]]], env)), [1, 2])
+        # adding to the front does not copy the list
+        built = lab.evaluate(['build', 5000, ['list']], env)
+        self.assertEqual((len(built), built[0], built[4999], built.next.elt), (5000, 1, 5000, 2))
+        self.assertEqual(list_from_ll(lab.evaluate(['concat', 'tail'], env)), [3, 4, 5])
+
+    def test_indexing_prepended_lists(self):
+        env = lab.Environment()
+        for program in lab.parse_program('''
+            (define (build n acc) (if (=? n 0) acc (build (- n 1) (concat (list n) acc))))
+            (define (sum-at l i acc) (if (=? i (length l)) acc (sum-at l (+ i 1) (+ acc (elt-at-index l i)))))
+            (define built (build 3000 (list)))
+            (define short (concat (list 1) (list 2) (list 3)))
+        '''):
+            lab.evaluate(program, env)
+        self.assertEqual(lab.evaluate(['sum-at', 'built', 0, 0], env), 3000 * 3001 // 2)
+        built = env.symbols['built']
+        # the chain is flattened once, and stays shared
+        self.assertEqual(len(built.flat), 3000)
+        self.assertIsNotNone(built.rest)
+        self.assertEqual((built.next.elt, built.next[2998], built.next.next[0]), (2, 3000, 3))
+        self.assertEqual(list(lab.evaluate(['cdr', ['cdr', 'built']], env))[:3], [3, 4, 5])
+        self.assertIsInstance(built.next, lab.NumberList)
+        # a few lists are walked without flattening
+        short = env.symbols['short']
+        self.assertEqual([short[i] for i in range(3)], [1, 2, 3])
+        self.assertIsNone(short.flat)
+
+
+class Test26_InlineCaches(LispTest):
+    def test_cached_globals_follow_definitions(self):
+        for vm in (False, True):
+            env = lab.Environment()
+            for program in lab.parse_program('''
+                (define scale 2)
+                (define (double x) (* x 2))
+                (define (apply-twice x) (double (* scale (double x))))
+            '''):
+                lab.evaluate(program, env, vm=vm)
+            results = [lab.evaluate(['apply-twice', 1], env, vm=vm)]
+            lab.evaluate(['set!', 'scale', 3], env, vm=vm)
+            results.append(lab.evaluate(['apply-twice', 1], env, vm=vm))
+            lab.evaluate(['define', ['double', 'x'], ['+', 'x', 1]], env, vm=vm)
+            results.append(lab.evaluate(['apply-twice', 1], env, vm=vm))
+            lab.evaluate(['define', '*', '+'], env, vm=vm)
+            results.append(lab.evaluate(['apply-twice', 1], env, vm=vm))
+            self.assertEqual(results, [8, 12, 7, 6])
+
+    def test_cache_shared_between_environments(self):
+        # one compiled function body, run from two Environments in turn
+        code = [lab.compile_expression(program) for program in lab.parse_program('(define (get) scale) (get)')]
+        envs = [lab.Environment(), lab.Environment()]
+        for value, env in enumerate(envs):
+            env['scale'] = value
+        results = []
+        for env in envs + envs:
+            for expression in code:
+                result = expression(env)
+            results.append(result)
+        self.assertEqual(results, [0, 1, 0, 1])
+
+class Test27_Arithmetic(LispTest):
+    def test_fast_paths_match_variadic_builtins(self):
+        env = lab.Environment()
+        builtins = {'+': sum, '-': lab.sub, '*': lab.mult, '/': lab.div}
+        values = [7, -3, 2.5, 0, True, None]
+        for name, builtin in builtins.items():
+            lab.evaluate(['define', ['one', 'a'], [name, 'a']], env)
+            lab.evaluate(['define', ['two', 'a', 'b'], [name, 'a', 'b']], env)
+            lab.evaluate(['define', ['three', 'a', 'b', 'c'], [name, 'a', 'b', 'c']], env)
+            for a in values:
+                ins = [([name, a], [a])] if a is not None else []
+                ins += [(['one', a], [a])] + [(['two', a, b], [a, b]) for b in values]
+                ins += [(['three', a, b, 5], [a, b, 5]) for b in values]
+                for expression, operands in ins:
+                    result = self.make_tester(lab.evaluate)(expression, env)
+                    expected = self.make_tester(builtin)(operands)
+                    self.assertEqual(result, expected, (name, operands))
+                    if result['ok']:
+                        self.assertIs(type(result['output']), type(expected['output']))
+
+    def test_no_operands_and_rebinding(self):
+        env = lab.Environment()
+        for program in lab.parse_program('(define n 6) (define (f x) (- x)) (define (g x y) (- x y))'):
+            lab.evaluate(program, env)
+        self.assertEqual([lab.evaluate(expression, env) for expression in (['+'], ['*'], ['/', 'n'], ['f', 'n'], ['g', 'n', 1])], [0, 1, 1, -6, 5])
+        lab.evaluate(['define', '-', '+'], env)
+        self.assertEqual([lab.evaluate(expression, env) for expression in (['f', 'n'], ['g', 'n', 1])], [6, 7])
+
+class Test28_FrameReuse(LispTest):
+    def test_escape_analysis(self):
+        escaping = ['(lambda (y) (+ x y))', '(begin (define (g y) y) (g x))', '(let ((y 1)) (map (lambda (z) (+ y z)) x))']
+        contained = ['(+ x 1)', '(begin (define y 2) (set! x y) (* x y))', '(let ((y 1)) (if (< x y) (f (- x 1)) y))']
+        for source in escaping:
+            self.assertTrue(lab.frame_escapes(lab.parse_program(source)[0]), source)
+        for source in contained:
+            self.assertFalse(lab.frame_escapes(lab.parse_program(source)[0]), source)
+
+    def test_frames_reused(self):
+        env = lab.Environment()
+        for program in lab.parse_program('''
+            (define (sum-to n) (if (=? n 0) 0 (+ n (sum-to (- n 1)))))
+            (define (even? n) (if (=? n 0) #t (odd? (- n 1))))
+            (define (odd? n) (begin (define m (- n 1)) (if (=? n 0) #f (even? m))))
+            (define (adder n) (lambda (x) (+ x n)))
+        '''):
+            lab.evaluate(program, env)
+        self.assertEqual(lab.evaluate(['sum-to', 100], env), 5050)
+        self.assertEqual(lab.evaluate(['sum-to', 3], env), 6)
+        frames = env.symbols['sum-to'].frames
+        self.assertEqual(len(frames), lab.FRAME_POOL_SIZE)
+        self.assertTrue(all(frame.values is None for frame in frames))
+        self.assertEqual([lab.evaluate(['even?', n], env) for n in (10, 7)], [True, False])
+        self.assertEqual(len(env.symbols['odd?'].frames), 1)
+        # frames kept by the closures they make are never reused
+        self.assertIsNone(env.symbols['adder'].frames)
+        lab.evaluate(['define', 'add1', ['adder', 1]], env)
+        lab.evaluate(['define', 'add2', ['adder', 2]], env)
+        self.assertEqual([lab.evaluate(['add1', 10], env), lab.evaluate(['add2', 10], env)], [11, 12])
+
+    def test_pool_emptied_before_pop(self):
+        # another thread takes the last frame between a check of the pool
+        # and the pop
+        class RacingPool(list):
+            def pop(self):
+                if len(self):
+                    list.pop(self)
+                return list.pop(self)
+        env = lab.Environment()
+        lab.evaluate(lab.parse_program('(define (sum-to n) (if (=? n 0) 0 (+ n (sum-to (- n 1)))))')[0], env)
+        function = env.symbols['sum-to']
+        function.frames = RacingPool([lab.Frame(None, env)])
+        self.assertEqual([function([n]) for n in range(5)], [0, 1, 3, 6, 10])
+
+    def test_errors_leave_pool_usable(self):
+        env = lab.Environment()
+        lab.evaluate(lab.parse_program('(define (f x) (if (=? x 0) (car (list)) (+ 1 (f (- x 1)))))')[0], env)
+        self.assertRaises(lab.EvaluationError, lab.evaluate, ['f', 5], env)
+        lab.evaluate(['define', 'car', ['lambda', ['x'], 0]], env)
+        self.assertEqual(lab.evaluate(['f', 5], env), 5)
+
+# runs the tests of a LispTest class on the bytecode VM
+class OnVirtualMachine():
+    def setUp(self):
+        self.backends = lab.result_and_env, lab.evaluate, lab.evaluate_file
+        lab.result_and_env, lab.evaluate, lab.evaluate_file = [self.on_vm(func) for func in self.backends]
+
+    def tearDown(self):
+        lab.result_and_env, lab.evaluate, lab.evaluate_file = self.backends
+
+    @staticmethod
+    def on_vm(func):
+        def run(*args, **kwargs):
+            kwargs['vm'] = True
+            return func(*args, **kwargs)
+        return run
+
+for test_class in [Test1_OldTests, Test2_NewTestsForOldBehaviors, Test3_Conditionals, Test4_Lists,
+                   Test5_Let_SetBang_Begin, Test6_Files, Test7_DeepNesting, Test8_RealPrograms,
+                   Test9_SourceReader, Test10_TailCalls, Test11_LexicalAddressing, Test12_ArrayLists,
+                   Test13_NumberLists, Test14_Comparisons, Test18_Memoize, Test27_Arithmetic]:
+    name = test_class.__name__ + '_VM'
+    globals()[name] = type(name, (OnVirtualMachine, test_class), {})
+del test_class
+
+
 if __name__ == '__main__':
     res = unittest.main(verbosity=3, exit=False)